@@ -2,15 +2,25 @@ import os
 import click
 from flask import Flask, render_template, request
 from flask_login import current_user
-from flask_sqlalchemy import get_debug_queries
 from flask_wtf.csrf import CSRFError
+from sqlalchemy import or_
 
+from bluelog.assets import assets
 from bluelog.blueprints.admin import admin_bp
 from bluelog.blueprints.auth import auth_bp
 from bluelog.blueprints.blog import blog_bp
-from bluelog.extensions import bootstrap, db, login_manager, csrf, ckeditor, mail, moment, toolbar
-from bluelog.models import Admin, Post, Category, Comment, Link
+from bluelog.caches import site_cache, page_cache, get_admin, get_categories, get_links, TemplateBytecodeCache, \
+    compile_templates
+from bluelog.extensions import bootstrap, db, login_manager, csrf, ckeditor, mail, moment, migrate
+from bluelog.feeds import expire_feeds
+from bluelog.models import Admin, Post, Category, Comment, Link, Outbox
+from bluelog.compression import compressor
+from bluelog.metrics import metrics
 from bluelog.configs import config
+from bluelog.querybudget import check_queries
+from bluelog.rendering import RENDER_VERSION, render_body
+from bluelog.schema import reset_schema, adopt as adopt_database
+from bluelog.search import rebuild_index
 
 
 def create_app(config_name=None):
@@ -21,6 +31,8 @@ def create_app(config_name=None):
     app.config.from_object(config[config_name])
     app.jinja_env.trim_blocks = True
     app.jinja_env.lstrip_blocks = True
+    if app.config['BLOG_TEMPLATE_CACHE']:
+        app.jinja_env.bytecode_cache = TemplateBytecodeCache(os.path.join(app.config['BLOG_CACHE_DIR'], 'templates'))
 
     register_extensions(app)
     register_blueprints(app)
@@ -28,19 +40,34 @@ def create_app(config_name=None):
     register_errors(app)
     register_template_context(app)
     register_shell_context(app)
+    register_query_checks(app)
+
+    # gunicorn --preload 时在主进程中加载一次，worker fork 后直接使用
+    if app.config['BLOG_PRELOAD_TEMPLATES']:
+        compile_templates(app)
 
     return app
 
 
 def register_extensions(app):
+    # after_request 钩子按注册的相反顺序执行，压缩最先注册，在工具栏等修改响应之后执行。
+    # 统计的钩子插入在最前面，计时包含其他所有钩子
+    compressor.init_app(app)
+    metrics.init_app(app)
     bootstrap.init_app(app)
     db.init_app(app)
+    migrate.init_app(app, db)
     login_manager.init_app(app)
     csrf.init_app(app)
     ckeditor.init_app(app)
     mail.init_app(app)
     moment.init_app(app)
-    toolbar.init_app(app)
+    if app.config['BLOG_DEBUG_TOOLBAR']:
+        # 只在开发环境中导入
+        from flask_debugtoolbar import DebugToolbarExtension
+        app.extensions['debugtoolbar'] = DebugToolbarExtension(app)
+    page_cache.init_app(app)
+    assets.init_app(app)
 
 
 def register_blueprints(app):
@@ -49,6 +76,11 @@ def register_blueprints(app):
     app.register_blueprint(auth_bp, url_prefix='/auth')
 
 
+def register_query_checks(app):
+    if app.config['SQLALCHEMY_RECORD_QUERIES']:
+        app.after_request(check_queries)
+
+
 def register_shell_context(app):
     @app.shell_context_processor
     def make_shell_context():
@@ -57,16 +89,17 @@ def register_shell_context(app):
             'Admin': Admin,
             'Post': Post,
             'Category': Category,
-            'Comment': Comment
+            'Comment': Comment,
+            'Outbox': Outbox
         }
 
 
 def register_template_context(app):
     @app.context_processor
     def make_template_context():
-        admin = Admin.query.first()
-        categories = Category.query.order_by(Category.name).all()
-        links = Link.query.order_by(Link.name).all()
+        admin = get_admin()
+        categories = get_categories()
+        links = get_links()
         if current_user.is_authenticated:
             unread_comments_count = Comment.query.filter_by(read=False).count()
         else:
@@ -108,8 +141,7 @@ def register_commands(app):
         '''初始化博客'''
 
         click.echo('初始化数据库...')
-        db.drop_all()
-        db.create_all()
+        reset_schema()
 
         click.echo('创建管理员账户...')
         admin = Admin(
@@ -127,6 +159,8 @@ def register_commands(app):
         db.session.add(category)
 
         db.session.commit()
+        rebuild_index()
+        site_cache.expire()
 
         if not os.path.exists(config['base'].CKEDITOR_UPLOAD_PATH):
             click.echo('图像上传路径不存在，创建中...')
@@ -135,19 +169,30 @@ def register_commands(app):
         click.echo('完成')
 
     @app.cli.command()
-    @click.option('--category', default=10, help='Quantity of categories, default is 10.')
-    @click.option('--post', default=50, help='Quantity of posts, default is 50.')
-    @click.option('--comment', default=500, help='Quantity of comments, default is 500.')
-    def forge(category, post, comment):
+    @click.option('--category', '--categories', default=10, help='Quantity of categories, default is 10.')
+    @click.option('--post', '--posts', default=50, help='Quantity of posts, default is 50.')
+    @click.option('--comment', '--comments', default=500, help='Quantity of comments, default is 500.')
+    @click.option('--bulk', is_flag=True, help='Stream rows with batched Core inserts, for large datasets.')
+    @click.option('--batch', default=5000, help='Rows per insert batch in bulk mode, default is 5000.')
+    @click.option('--seed', type=int, help='Seed for the random generator in bulk mode.')
+    def forge(category, post, comment, bulk, batch, seed):
         '''生成虚拟数据'''
-        from bluelog.fakes import fake_admin, fake_categories, fake_posts, fake_comments, fake_links
+        from bluelog.fakes import fake_admin, fake_categories, fake_posts, fake_comments, fake_links, bulk_forge
 
-        db.drop_all()
-        db.create_all()
+        reset_schema()
 
         click.echo('生成管理员...')
         fake_admin()
 
+        if bulk:
+            click.echo(f'批量生成 {category} 个分类，{post} 篇文章，{comment} 条评论...')
+            bulk_forge(category, post, comment, batch_size=batch, seed=seed)
+            fake_links()
+            site_cache.expire()
+            click.echo('未建立搜索索引，需要时运行 flask reindex')
+            click.echo('完成')
+            return
+
         click.echo(f'生成 {category} 个分类...')
         fake_categories(category)
 
@@ -160,8 +205,231 @@ def register_commands(app):
         click.echo('生成链接...')
         fake_links()
 
+        click.echo('统计文章数和评论数...')
+        Category.recount()
+        Post.recount()
+        db.session.commit()
+        Comment.rebuild_paths()
+
+        click.echo('建立搜索索引...')
+        rebuild_index()
+        site_cache.expire()
+
         if not os.path.exists(config['base'].CKEDITOR_UPLOAD_PATH):
             click.echo('图像上传路径不存在，创建中...')
             os.mkdir(config['base'].CKEDITOR_UPLOAD_PATH)
 
-        click.echo('完成')
\ No newline at end of file
+        click.echo('完成')
+
+    @app.cli.command()
+    def recount():
+        '''重新统计分类文章数和文章评论数'''
+        click.echo('统计分类文章数...')
+        Category.recount()
+        click.echo('统计文章评论数...')
+        Post.recount()
+        db.session.commit()
+        site_cache.expire()
+        click.echo('完成')
+
+    @app.cli.command('rebuild-threads')
+    @click.option('--batch', default=5000, help='每批更新的评论数，默认 5000')
+    def rebuild_threads(batch):
+        '''根据 replied_id 重建评论的 thread_id 和物化路径'''
+        count = Comment.rebuild_paths(batch)
+        page_cache.clear()
+        click.echo(f'已处理 {count} 条评论')
+
+    @app.cli.command('update-excerpts')
+    @click.option('--all', 'update_all', is_flag=True, help='重新计算所有文章，默认只处理没有摘要的文章')
+    @click.option('--batch', default=500, help='每批处理的文章数，默认 500')
+    def update_excerpts(update_all, batch):
+        '''根据正文生成文章摘要和字数'''
+        Post.update_excerpts(update_all, batch, progress=lambda total: click.echo(f'已处理 {total} 篇文章'))
+        page_cache.clear()
+        expire_feeds()
+        click.echo('完成')
+
+    @app.cli.command()
+    @click.option('--all', 'rerender_all', is_flag=True, help='重新渲染所有文章，默认只处理渲染版本过旧的文章')
+    @click.option('--batch', default=500, help='每批处理的文章数，默认 500')
+    def rerender(rerender_all, batch):
+        '''按当前的渲染流程重新生成文章正文 HTML'''
+        query = db.session.query(Post.id, Post.body).order_by(Post.id)
+        if not rerender_all:
+            query = query.filter(or_(Post.render_version.is_(None), Post.render_version != RENDER_VERSION))
+        last_id = 0
+        total = 0
+        while True:
+            rows = query.filter(Post.id > last_id).limit(batch).all()
+            if not rows:
+                break
+            db.session.bulk_update_mappings(Post, [
+                {'id': id_, 'body_html': render_body(body), 'render_version': RENDER_VERSION} for id_, body in rows
+            ])
+            db.session.commit()
+            last_id = rows[-1].id
+            total += len(rows)
+            click.echo(f'已渲染 {total} 篇文章')
+        page_cache.clear()
+        expire_feeds()
+        click.echo('完成')
+
+    @app.cli.command()
+    @click.option('--batch', default=500, help='每批处理的文章数，默认 500')
+    def reindex(batch):
+        '''重建全文搜索索引'''
+        count = rebuild_index(batch)
+        click.echo(f'已索引 {count} 篇文章')
+
+    @app.cli.command(with_appcontext=False)
+    @click.option('--forge', 'forge_data', is_flag=True, help='压测前用批量模式重新生成数据，会清空数据库')
+    @click.option('--categories', default=20, help='生成的分类数，默认 20')
+    @click.option('--posts', default=10000, help='生成的文章数，默认 10000')
+    @click.option('--comments', default=200000, help='生成的评论数，默认 200000')
+    @click.option('--seed', default=0, help='生成数据的随机种子，默认 0')
+    @click.option('--yes', is_flag=True, help='清空数据库前不再确认')
+    @click.option('--requests', '-n', default=50, help='每个场景的请求次数，默认 50')
+    @click.option('--only', multiple=True, help='只运行指定的场景，可以多次使用')
+    @click.option('--output', '-o', default='bench.json', help='结果 JSON 文件，默认 bench.json')
+    @click.option('--compare', 'compare_path', type=click.Path(exists=True, dir_okay=False),
+                  help='和之前的结果 JSON 对比')
+    def bench(forge_data, categories, posts, comments, seed, yes, requests, only, output, compare_path):
+        '''压测主要端点，输出延迟百分位、吞吐量和 SQL 查询数'''
+        import json
+        from bluelog.bench import run_benchmark, write_results, compare
+        from bluelog.fakes import fake_admin, fake_links, bulk_forge
+
+        if forge_data:
+            if not yes:
+                click.confirm('将清空数据库并重新生成数据，是否继续？', abort=True)
+            with app.app_context():
+                reset_schema()
+                fake_admin()
+                bulk_forge(categories, posts, comments, seed=seed)
+                fake_links()
+                site_cache.expire()
+
+        results = run_benchmark(app, requests, only)
+        write_results(results, output)
+        click.echo(f'结果已写入 {output}')
+        if compare_path:
+            with open(compare_path) as f:
+                compare(json.load(f), results)
+
+    @app.cli.command(with_appcontext=False)
+    @click.argument('directory', type=click.Path(file_okay=False))
+    @click.option('--workers', '-w', default=os.cpu_count(), help='渲染进程数，默认为 CPU 核数')
+    @click.option('--full', is_flag=True, help='忽略清单，重新渲染所有页面')
+    @click.option('--base-url', default='http://localhost/', help='页面中完整链接使用的地址，默认 http://localhost/')
+    def export(directory, workers, full, base_url):
+        '''把公开页面导出为静态文件，再次导出时只重新渲染有变化的页面'''
+        from bluelog.export import export_site
+        rendered, written, removed, errors = export_site(app, directory, workers, full, base_url, log=click.echo)
+        for error in errors:
+            click.echo(error, err=True)
+        click.echo(f'渲染 {rendered} 个页面，写入 {written} 个，删除 {removed} 个，失败 {len(errors)} 个')
+
+    # Flask-Migrate 的 flask db 命令组在加载应用之前就已确定，应用中定义的命令不能加入其中
+    @app.cli.command('db-adopt')
+    def db_adopt():
+        '''把 db.create_all() 建立的数据库纳入迁移管理并升级到最新版本'''
+        revision = adopt_database()
+        if revision is None:
+            click.echo('数据库已经由迁移管理，如需升级请运行 flask db upgrade')
+            return
+        site_cache.expire()
+        page_cache.clear()
+        click.echo('完成，如需生成正文 HTML 和搜索索引，运行 flask rerender 和 flask reindex')
+
+    @app.cli.command('db-explain')
+    def db_explain():
+        '''输出主要端点查询的执行计划（SQLite 和 MySQL）'''
+        from bluelog.schema import explain_queries, explain as explain_query
+        for name, query in explain_queries():
+            columns, rows = explain_query(query)
+            click.echo(f'== {name}')
+            click.echo(str(query.statement.compile(dialect=db.engine.dialect)))
+            click.echo(' | '.join(columns))
+            for row in rows:
+                click.echo(' | '.join(str(value) for value in row))
+            click.echo()
+
+    @app.cli.command('mail-worker')
+    @click.option('--once', is_flag=True, help='发送完到期的邮件后退出')
+    def mail_worker(once):
+        '''发送发件箱中的邮件'''
+        from bluelog.emails import run_worker
+        click.echo('开始发送邮件...')
+        run_worker(once)
+
+    @app.cli.command('compile-templates')
+    def compile_templates_command():
+        '''预先编译全部模板，写入 BLOG_CACHE_DIR/templates，部署后新启动的 worker 直接加载'''
+        if app.jinja_env.bytecode_cache is None:
+            raise click.ClickException('没有打开模板缓存，见 BLOG_TEMPLATE_CACHE')
+        click.echo(f'已编译 {compile_templates(app)} 个模板')
+
+    @app.cli.command('startup-profile', with_appcontext=False)
+    @click.option('--config', 'config_name', default='production', type=click.Choice(sorted(config)),
+                  help='使用的配置，默认 production')
+    @click.option('--url', default='/', help='创建应用后请求的地址，默认 /')
+    @click.option('--limit', default=20, help='列出的模块数，默认 20')
+    def startup_profile(config_name, url, limit):
+        '''在新进程中统计导入各模块、创建应用各阶段和前两次请求的耗时'''
+        from bluelog.startup import run_profile, print_report
+        timings, modules = run_profile(config_name, url)
+        print_report(timings, modules, limit)
+
+    @app.cli.group('assets')
+    def assets_group():
+        '''管理静态文件'''
+
+    @assets_group.command('build')
+    def build_assets():
+        '''给静态文件加上内容指纹并预先压缩，重启应用后生效'''
+        from bluelog.assets import build
+        manifest = build(app.static_folder, log=click.echo)
+        click.echo(f'已处理 {len(manifest)} 个文件')
+
+    @assets_group.command('clean')
+    def clean_assets():
+        '''删除构建结果，恢复使用原始文件名'''
+        import shutil
+        from bluelog.assets import DIST_DIR
+        shutil.rmtree(os.path.join(app.static_folder, DIST_DIR), ignore_errors=True)
+        click.echo('完成')
+
+    @app.cli.group('metrics')
+    def metrics_group():
+        '''查看和清空请求统计'''
+
+    @metrics_group.command('show')
+    def show_metrics():
+        '''输出所有 worker 汇总的统计，和 /metrics 相同'''
+        from bluelog.metrics import exposition
+        if not metrics.enabled:
+            raise click.ClickException('没有打开统计，见 BLOG_METRICS')
+        click.echo(''.join(exposition(metrics.collect(include_self=False), metrics.buckets)), nl=False)
+
+    @metrics_group.command('clear')
+    def clear_metrics():
+        '''删除所有 worker 的统计文件，已经退出的 worker 的计数随之清除'''
+        if not metrics.enabled:
+            raise click.ClickException('没有打开统计，见 BLOG_METRICS')
+        metrics.clear()
+        click.echo('完成')
+
+    @app.cli.group('page-cache')
+    def page_cache_group():
+        '''管理整页缓存'''
+
+    @page_cache_group.command('clear')
+    @click.option('--expired', is_flag=True, help='只删除过期的文件并把缓存目录限制在 BLOG_PAGE_CACHE_MAX_SIZE 以内')
+    def clear_page_cache(expired):
+        '''清空整页缓存'''
+        if expired:
+            click.echo(f'删除了 {page_cache.sweep()} 个文件')
+            return
+        page_cache.clear()
+        click.echo('完成')
@@ -0,0 +1,130 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+from flask import current_app, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # brotli 是可选依赖，没有安装时只生成 gzip
+    brotli = None
+
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+COMPRESS_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt', '.map', '.ico'}
+# 加了指纹的文件内容不会变化，缓存一年
+MAX_AGE = 365 * 24 * 3600
+
+
+def _fingerprint(path, digest):
+    stem, ext = os.path.splitext(path)
+    return f'{stem}.{digest}{ext}'
+
+
+def _write_atomic(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def build(static_folder, log=print):
+    '''
+    把 static_folder 下的文件复制到 static_folder/dist，文件名中加入内容哈希，
+    文本文件另外生成 .gz 和 .br（安装了 brotli 时），最后写入 manifest.json，返回清单。
+    '''
+    dist = os.path.join(static_folder, DIST_DIR)
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder and DIST_DIR in dirs:
+            dirs.remove(DIST_DIR)
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            filename = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+            hashed = f'{DIST_DIR}/' + _fingerprint(filename, hashlib.sha256(data).hexdigest()[:12])
+            target = os.path.join(static_folder, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            _write_atomic(target, data)
+
+            encodings = []
+            if os.path.splitext(name)[1].lower() in COMPRESS_EXTENSIONS:
+                compressed = [('gzip', '.gz', gzip.compress(data, 9, mtime=0))]
+                if brotli is not None:
+                    compressed.append(('br', '.br', brotli.compress(data)))
+                for encoding, suffix, body in compressed:
+                    # 压缩后没有变小的文件不保留压缩版本
+                    if len(body) < len(data):
+                        _write_atomic(target + suffix, body)
+                        encodings.append(encoding)
+            manifest[filename] = {'path': hashed, 'encodings': encodings}
+            log(f'{filename} -> {hashed} {" ".join(encodings)}')
+    _write_atomic(os.path.join(dist, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+class Assets:
+    '''
+    读取 flask assets build 生成的清单，让 url_for('static', filename=...) 返回带指纹的文件名，
+    并接管 static 视图：带指纹的文件按 Accept-Encoding 返回预先压缩的版本，设置一年的 immutable 缓存。
+    BLOG_ASSETS_MANIFEST 为 False 或清单不存在时不做任何处理，开发时修改静态文件可以立即生效。
+    '''
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        self.hashed = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.manifest = {}
+        self.hashed = {}
+        app.extensions['assets'] = self
+        if not app.config['BLOG_ASSETS_MANIFEST'] or not app.static_folder:
+            return
+        try:
+            with open(os.path.join(app.static_folder, DIST_DIR, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            return
+        self.hashed = {entry['path']: entry for entry in self.manifest.values()}
+        app.url_defaults(self.inject_fingerprint)
+        app.view_functions['static'] = self.send_static_file
+
+    def inject_fingerprint(self, endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            entry = self.manifest.get(values['filename'])
+            if entry is not None:
+                values['filename'] = entry['path']
+
+    def send_static_file(self, filename):
+        app = current_app
+        entry = self.hashed.get(filename)
+        if entry is None:
+            return app.send_static_file(filename)
+
+        accepted = request.accept_encodings
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if encoding in entry['encodings'] and accepted[encoding]:
+                response = send_from_directory(app.static_folder, filename + suffix,
+                                               mimetype=mimetypes.guess_type(filename)[0], conditional=True)
+                response.content_encoding = encoding
+                break
+        else:
+            response = send_from_directory(app.static_folder, filename, conditional=True)
+        if entry['encodings']:
+            response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.max_age = MAX_AGE
+        response.cache_control.immutable = True
+        return response
+
+
+assets = Assets()
@@ -0,0 +1,184 @@
+import json
+import math
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime
+
+import click
+from flask import current_app
+from sqlalchemy import func
+
+from bluelog.configs import basedir
+from bluelog.extensions import db
+from bluelog.models import Admin, Category, Post, Comment
+from bluelog.querybudget import record_queries
+
+
+def percentile(values, percent):
+    '''最近秩法求百分位数，values 需已排序'''
+    if not values:
+        return 0
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=basedir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_scenarios():
+    '''根据当前数据生成要压测的请求：(名称, 方法, url, 是否登录, 表单数据)'''
+    per_page = current_app.config['BLOG_POST_PER_PAGE']
+    comment_per_page = current_app.config['BLOG_COMMENT_PER_PAGE']
+    post_total = Post.query.count()
+    comment_total = Comment.query.count()
+    last_page = max(1, -(-post_total // per_page))
+    category = Category.query.order_by(Category.post_count.desc()).first()
+    hot_post = Post.query.order_by(Post.comment_count.desc()).first()
+
+    scenarios = [
+        ('index', 'GET', '/', False, None),
+        ('index_middle', 'GET', f'/?page={max(1, last_page // 2)}', False, None),
+        ('index_last', 'GET', f'/?page={last_page}', False, None),
+        ('about', 'GET', '/about/', False, None),
+    ]
+    if category is not None:
+        scenarios.append(('show_category', 'GET', f'/category/{category.id}/', False, None))
+    if hot_post is not None:
+        # 文章页按顶层评论分页
+        threads = Comment.query.filter_by(post_id=hot_post.id, replied_id=None).count()
+        comment_pages = max(1, -(-threads // comment_per_page))
+        scenarios += [
+            ('show_post_hot', 'GET', f'/post/{hot_post.id}/', False, None),
+            ('show_post_hot_last', 'GET', f'/post/{hot_post.id}/?page={comment_pages}', False, None),
+            ('comment_post', 'POST', f'/post/{hot_post.id}/', False,
+             {'author': 'bench', 'email': 'bench@example.com', 'body': 'benchmark comment'}),
+        ]
+    manage_comment_last = max(1, -(-comment_total // comment_per_page))
+    scenarios += [
+        ('admin_manage_post', 'GET', '/admin/post/manage/', True, None),
+        ('admin_manage_comment', 'GET', '/admin/comment/manage/?filter=all', True, None),
+        ('admin_manage_comment_deep', 'GET',
+         f'/admin/comment/manage/?filter=all&page={max(1, manage_comment_last // 2)}', True, None),
+        ('admin_manage_comment_unread', 'GET', '/admin/comment/manage/', True, None),
+    ]
+    return scenarios
+
+
+def run_scenario(app, client, method, url, data, requests, warmup=2):
+    for _ in range(warmup):
+        client.open(url, method=method, data=data)
+
+    latencies = []
+    query_counts = []
+    query_times = []
+    statuses = {}
+    cache_hits = 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        with record_queries(app) as recorded:
+            start = time.perf_counter()
+            response = client.open(url, method=method, data=data)
+            latencies.append((time.perf_counter() - start) * 1000)
+        queries = [query for _, endpoint_queries in recorded for query in endpoint_queries]
+        query_counts.append(len(queries))
+        query_times.append(sum(query.duration for query in queries) * 1000)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        cache_hits += response.headers.get('X-Page-Cache') == 'HIT'
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'url': url,
+        'method': method,
+        'requests': requests,
+        'status': {str(code): count for code, count in statuses.items()},
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(latencies[-1], 3),
+        'rps': round(requests / elapsed, 1),
+        'queries': round(sum(query_counts) / requests, 2),
+        'sql_ms': round(sum(query_times) / requests, 3),
+        'page_cache_hits': cache_hits,
+    }
+
+
+def run_benchmark(app, requests, only=None):
+    '''
+    用测试客户端依次请求各个场景，返回可以写入 JSON 的结果。
+    需要在应用上下文之外调用，否则所有请求共用同一个应用上下文，g 和记录的查询会互相累积。
+    '''
+    with app.app_context():
+        admin = Admin.query.first()
+        if admin is None:
+            raise click.ClickException('没有数据，先运行 flask init 或使用 --forge')
+        scenarios = build_scenarios()
+        admin_id = admin.id
+
+    mail_state = app.extensions['mail']
+    csrf_enabled = app.config.get('WTF_CSRF_ENABLED', True)
+    suppress = mail_state.suppress
+    mail_state.suppress = True
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    anonymous = app.test_client()
+    logged_in = app.test_client()
+    with logged_in.session_transaction() as session:
+        session['_user_id'] = str(admin_id)
+        session['_fresh'] = True
+
+    results = {}
+    try:
+        for name, method, url, login, data in scenarios:
+            if only and name not in only:
+                continue
+            results[name] = run_scenario(app, logged_in if login else anonymous, method, url, data, requests)
+            result = results[name]
+            click.echo(f'{name:<28} p50 {result["p50_ms"]:>8.2f}ms  p95 {result["p95_ms"]:>8.2f}ms  '
+                       f'p99 {result["p99_ms"]:>8.2f}ms  {result["rps"]:>8.1f} req/s  '
+                       f'{result["queries"]:>6.1f} queries  {result["sql_ms"]:>7.2f}ms sql')
+    finally:
+        mail_state.suppress = suppress
+        app.config['WTF_CSRF_ENABLED'] = csrf_enabled
+
+    with app.app_context():
+        return {
+            'meta': {
+                'revision': _git_revision(),
+                'time': datetime.utcnow().isoformat(),
+                'python': platform.python_version(),
+                'database': db.engine.dialect.name,
+                'env': app.config.get('ENV'),
+                'debug': app.debug,
+                'pagination': app.config['BLOG_PAGINATION'],
+                'page_cache': app.config['BLOG_PAGE_CACHE'],
+                'requests': requests,
+                'posts': db.session.query(func.count(Post.id)).scalar(),
+                'comments': db.session.query(func.count(Comment.id)).scalar(),
+            },
+            'results': results,
+        }
+
+
+def compare(old, new):
+    '''逐项对比两次结果的 p50、p95 和查询数'''
+    click.echo(f'{"":<28} {old["meta"]["revision"] or "old":>20} {new["meta"]["revision"] or "new":>20}')
+    for name, result in new['results'].items():
+        before = old['results'].get(name)
+        if before is None:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'queries'):
+            change = (result[key] - before[key]) / before[key] * 100 if before[key] else 0
+            click.echo(f'{name + " " + key:<28} {before[key]:>20} {result[key]:>20}  {change:+.1f}%')
+
+
+def write_results(results, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
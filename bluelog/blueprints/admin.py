@@ -1,12 +1,20 @@
-import os
-from flask import render_template, flash, redirect, url_for, request, current_app, Blueprint, send_from_directory, make_response
+from flask import render_template, flash, redirect, url_for, request, current_app, Blueprint, make_response, \
+    jsonify, abort
 from flask_login import login_required, current_user
 from flask_ckeditor import upload_success, upload_fail
+from sqlalchemy import func
+from werkzeug.exceptions import RequestEntityTooLarge
 
+from bluelog.caches import site_cache, page_cache, get_categories
 from bluelog.extensions import db
-from bluelog.forms import SettingForm, PostForm, CategoryForm, LinkForm
+from bluelog.feeds import expire_feeds
+from bluelog.forms import SettingForm, PostForm, CategoryForm, MergeCategoryForm, LinkForm
 from bluelog.models import Post, Category, Comment, Link
-from bluelog.utils import redirect_back, allowed_file, random_filename
+from bluelog.pagination import paginate
+from bluelog.querybudget import query_budget
+from bluelog.search import index_post, remove_post, remove_posts
+from bluelog.uploads import UploadError, save_upload, variant_pool, display_name, serve as serve_upload
+from bluelog.utils import redirect_back, allowed_file
 
 
 admin_bp = Blueprint('admin', __name__)
@@ -23,6 +31,7 @@ def settings():
         current_user.blog_sub_title = form.blog_sub_title.data
         current_user.about = form.about.data
         db.session.commit()
+        site_cache.expire()
         flash('设置已更新', 'success')
         return redirect(url_for('blog.index'))
     form.name.data = current_user.name
@@ -34,13 +43,14 @@ def settings():
 
 
 @admin_bp.route('/post/manage/')
+@query_budget(2)
 @login_required
 def manage_post():
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['BLOG_MANAGE_POST_PER_PAGE'])
+    total = sum(category.post_count for category in get_categories())
+    query = Post.query.options(db.defer(Post.body), db.joinedload(Post.category))
+    pagination = paginate(query, Post, current_app.config['BLOG_MANAGE_POST_PER_PAGE'], total=total)
     posts = pagination.items
-    return render_template('admin/manage_post.html', page=page, pagination=pagination, posts=posts)
+    return render_template('admin/manage_post.html', pagination=pagination, posts=posts)
 
 
 @admin_bp.route('/post/new/', methods=['GET', 'POST'])
@@ -51,9 +61,15 @@ def new_post():
         title = form.title.data
         body = form.body.data
         category = Category.query.get(form.category.data)
-        post = Post(title=title, body=body, category=category)
+        post = Post(title=title, category=category)
+        post.set_body(body)
+        category.post_count = Category.post_count + 1
         db.session.add(post)
+        db.session.flush()
+        index_post(post)
         db.session.commit()
+        site_cache.expire()
+        expire_feeds()
         flash('文章已创建', 'success')
         return redirect(url_for('blog.show_post', post_id=post.id))
     return render_template('admin/new_post.html', form=form)
@@ -66,9 +82,19 @@ def edit_post(post_id):
     post = Post.query.get_or_404(post_id)
     if form.validate_on_submit():
         post.title = form.title.data
-        post.body = form.body.data
-        post.category = Category.query.get(form.category.data)
+        post.set_body(form.body.data)
+        recategorized = post.category_id != form.category.data
+        if recategorized:
+            post.category.post_count = Category.post_count - 1
+            post.category = Category.query.get(form.category.data)
+            post.category.post_count = Category.post_count + 1
+        index_post(post)
         db.session.commit()
+        expire_feeds()
+        if recategorized:
+            site_cache.expire()
+        else:
+            page_cache.purge('index', f'category-{post.category_id}', f'post-{post.id}')
         flash('文章已更新', 'success')
         return redirect(url_for('blog.show_post', post_id=post.id))
     form.title.data = post.title
@@ -81,12 +107,53 @@ def edit_post(post_id):
 @login_required
 def delete_post(post_id):
     post = Post.query.get_or_404(post_id)
+    post.category.post_count = Category.post_count - 1
+    remove_post(post.id)
     db.session.delete(post)
     db.session.commit()
+    site_cache.expire()
+    expire_feeds()
     flash('文章已删除', 'success')
     return redirect_back()
 
 
+@admin_bp.route('/post/batch/', methods=['POST'])
+@login_required
+def batch_post():
+    # 'delete'：删除文章及评论，'move'：移动到 category_id 指定的分类，'open-comment' / 'close-comment'：允许 / 禁止评论
+    action = request.form.get('action')
+    # 所选文章来自当前页，数量不会超过 IN 列表的限制
+    ids = request.form.getlist('ids', type=int)
+    if not ids:
+        flash('没有选择文章', 'warning')
+        return redirect_back()
+
+    if action == 'delete':
+        post_count, comment_count = Post.delete_many(ids)
+        remove_posts(ids)
+        db.session.commit()
+        site_cache.expire()
+        expire_feeds()
+        flash(f'已删除 {post_count} 篇文章和 {comment_count} 条评论', 'success')
+    elif action == 'move':
+        category = Category.query.get_or_404(request.form.get('category_id', type=int))
+        moved = Post.move_many(ids, category)
+        db.session.commit()
+        site_cache.expire()
+        expire_feeds()
+        flash(f'已将 {moved} 篇文章移动到“{category.name}”', 'success')
+    elif action in ('open-comment', 'close-comment'):
+        can_comment = action == 'open-comment'
+        count = Post.query.filter(Post.id.in_(ids), Post.can_comment != can_comment) \
+            .update({Post.can_comment: can_comment}, synchronize_session=False)
+        db.session.commit()
+        page_cache.purge(*(f'post-{post_id}' for post_id in ids))
+        flash(f'已{"允许" if can_comment else "禁止"}评论 {count} 篇文章', 'success')
+    else:
+        abort(400)
+    return redirect_back()
+
+
 @admin_bp.route('/post/<int:post_id>/set-comment/', methods=['POST'])
 @login_required
 def set_comment(post_id):
@@ -98,23 +165,28 @@ def set_comment(post_id):
         post.can_comment = True
         flash('已允许评论', 'success')
     db.session.commit()
+    page_cache.purge(f'post-{post.id}')
     return redirect_back()
 
 
 @admin_bp.route('/comment/manage/')
+@query_budget(3)
 @login_required
 def manage_comment():
     filter_rule = request.args.get('filter', 'unread')  # 'unread', 'all', 'admin'
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BLOG_COMMENT_PER_PAGE']
+    # 全部评论的总数用文章评论数之和代替 COUNT(*)，来自管理员的评论没有现成计数
     if filter_rule == 'unread':
         filtered_comments = Comment.query.filter_by(read=False)
+        total = filtered_comments.count
     elif filter_rule == 'admin':
         filtered_comments = Comment.query.filter_by(from_admin=True)
+        total = None
     else:
         filtered_comments = Comment.query
+        total = lambda: db.session.query(func.coalesce(func.sum(Post.comment_count), 0)).scalar()
 
-    pagination = filtered_comments.order_by(Comment.timestamp.desc()).paginate(page, per_page=per_page)
+    pagination = paginate(filtered_comments, Comment, per_page, total=total)
     comments = pagination.items
     return render_template('admin/manage_comment.html', comments=comments, pagination=pagination)
 
@@ -122,9 +194,7 @@ def manage_comment():
 @admin_bp.route('/comment/readall/', methods=['POST'])
 @login_required
 def read_all_comment():
-    unread_comments = Comment.query.filter_by(read=False)
-    for comment in unread_comments:
-        comment.read = True
+    Comment.query.filter_by(read=False).update({Comment.read: True}, synchronize_session=False)
     db.session.commit()
     return redirect_back()
 
@@ -142,12 +212,45 @@ def read_comment(comment_id):
 @login_required
 def delete_comment(comment_id):
     comment = Comment.query.get_or_404(comment_id)
-    db.session.delete(comment)
+    _, post_ids = Comment.delete_threads([comment.id])
     db.session.commit()
+    page_cache.purge(*(f'post-{post_id}' for post_id in post_ids))
     flash('评论已删除', 'success')
     return redirect_back()
 
 
+@admin_bp.route('/comment/batch/', methods=['POST'])
+@login_required
+def batch_comment():
+    # 'read'：标为已读，'delete'：删除所选评论，'delete-author'：删除所选评论作者（按邮箱）的全部评论
+    action = request.form.get('action')
+    # 所选评论来自当前页，数量不会超过 IN 列表的限制
+    ids = request.form.getlist('ids', type=int)
+    if not ids:
+        flash('没有选择评论', 'warning')
+        return redirect_back()
+
+    if action == 'read':
+        count = Comment.query.filter(Comment.id.in_(ids)).update({Comment.read: True}, synchronize_session=False)
+        db.session.commit()
+        flash(f'已将 {count} 条评论标为已读', 'success')
+        return redirect_back()
+
+    if action == 'delete-author':
+        emails = {email for email, in db.session.query(Comment.email).filter_by(from_admin=False)
+                  .filter(Comment.id.in_(ids)) if email}
+        ids = [comment_id for comment_id, in db.session.query(Comment.id).filter_by(from_admin=False)
+               .filter(Comment.email.in_(emails))]
+    elif action != 'delete':
+        abort(400)
+
+    count, post_ids = Comment.delete_threads(ids)
+    db.session.commit()
+    page_cache.purge(*(f'post-{post_id}' for post_id in post_ids))
+    flash(f'已删除 {count} 条评论（包括回复）', 'success')
+    return redirect_back()
+
+
 @admin_bp.route('/category/manage/')
 @login_required
 def manage_category():
@@ -163,6 +266,7 @@ def new_category():
         category = Category(name=name)
         db.session.add(category)
         db.session.commit()
+        site_cache.expire()
         flash('新建分类成功', 'success')
         return redirect(url_for('.manage_category'))
     return render_template('admin/new_category.html', form=form)
@@ -179,6 +283,7 @@ def edit_category(category_id):
     if form.validate_on_submit():
         category.name = form.name.data
         db.session.commit()
+        site_cache.expire()
         flash('分类已更新', 'success')
         return redirect(url_for('.manage_category'))
 
@@ -194,10 +299,31 @@ def delete_category(category_id):
         flash('默认分类不可删除！', 'warning')
         return redirect(url_for('blog.index'))
     category.delete()
+    site_cache.expire()
+    expire_feeds()
     flash('分类已删除', 'success')
     return redirect(url_for('.manage_category'))
 
 
+@admin_bp.route('/category/<int:category_id>/merge/', methods=['GET', 'POST'])
+@login_required
+def merge_category(category_id):
+    category = Category.query.get_or_404(category_id)
+    if category.id == 1:
+        flash('默认分类不可合并！', 'warning')
+        return redirect(url_for('.manage_category'))
+    form = MergeCategoryForm(category)
+    if form.validate_on_submit():
+        target = Category.query.get_or_404(form.target.data)
+        moved = category.delete(target)
+        expire_feeds()
+        # 分类的文章数在侧边栏中，更新 site_cache 版本号会让所有缓存页面一起失效
+        site_cache.expire()
+        flash(f'已将 {moved} 篇文章移动到“{target.name}”，原分类已删除', 'success')
+        return redirect(url_for('.manage_category'))
+    return render_template('admin/merge_category.html', form=form, category=category)
+
+
 @admin_bp.route('/link/manage/')
 @login_required
 def manage_link():
@@ -214,6 +340,7 @@ def new_link():
         link = Link(name=name, url=url)
         db.session.add(link)
         db.session.commit()
+        site_cache.expire()
         flash('新建链接成功', 'success')
         return redirect(url_for('.manage_link'))
     return render_template('admin/new_link.html', form=form)
@@ -228,6 +355,7 @@ def edit_link(link_id):
         link.name = form.name.data
         link.url = form.url.data
         db.session.commit()
+        site_cache.expire()
         flash('链接已更新', 'success')
         return redirect(url_for('.manage_link'))
     form.name.data = link.name
@@ -241,26 +369,52 @@ def delete_link(link_id):
     link = Link.query.get_or_404(link_id)
     db.session.delete(link)
     db.session.commit()
+    site_cache.expire()
     flash('链接已删除', 'success')
     return redirect(url_for('.manage_link'))
 
 
+@admin_bp.route('/page-cache/')
+@login_required
+def page_cache_stats():
+    # 当前 worker 的命中统计，以及缓存后端中的页面数和大小
+    return jsonify(page_cache.stats())
+
+
 @admin_bp.route('/uploads/<path:filename>/')
 def get_image(filename):
-    return send_from_directory(current_app.config['CKEDITOR_UPLOAD_PATH'], filename)
+    response = serve_upload(filename)
+    if response is None:
+        abort(404)
+    return response
 
 
 @admin_bp.route('/upload/', methods=['POST'])
+@login_required
 def upload_image():
     f = request.files.get('upload')
-    if not allowed_file(f.filename):
+    if f is None or not allowed_file(f.filename):
         return upload_fail('仅允许上传图片！')
-    new_filename = random_filename(f.filename)
-    f.save(os.path.join(current_app.config['CKEDITOR_UPLOAD_PATH'], new_filename))
-    url = url_for('.get_image', filename=new_filename)
+    try:
+        filename, created = save_upload(f.stream, current_app.config['CKEDITOR_UPLOAD_PATH'],
+                                        current_app.config['BLOG_UPLOAD_MAX_SIZE'])
+    except UploadError as e:
+        return upload_fail(str(e))
+    if created:
+        variant_pool.submit(current_app._get_current_object(), filename)
+    url = url_for('.get_image', filename=display_name(filename))
     return upload_success(url=url)
 
 
+@admin_bp.errorhandler(RequestEntityTooLarge)
+def request_entity_too_large(e):
+    # 超过 MAX_CONTENT_LENGTH 的请求在 CSRF 检查读取表单时就被拒绝，视图不会执行，
+    # 图片上传在这里返回 CKEditor 能显示的错误
+    if request.endpoint == 'admin.upload_image':
+        return upload_fail(f'图片不能超过 {current_app.config["BLOG_UPLOAD_MAX_SIZE"] // 1024 // 1024}MB！')
+    return e
+
+
 @admin_bp.route('/change-theme/<theme_name>/')
 def change_theme(theme_name):
     if theme_name not in current_app.config['BLOG_THEMES'].keys():
@@ -1,47 +1,127 @@
-from flask import render_template, flash, redirect, url_for, request, current_app, Blueprint, abort
+from itertools import chain
+
+from flask import render_template, flash, redirect, url_for, request, current_app, Blueprint, abort, jsonify
 from flask_login import current_user
+from flask_sqlalchemy import Pagination
+from flask_wtf.csrf import generate_csrf
 
+from bluelog.caches import cache_page, page_cache, get_admin, get_categories
+from bluelog.database import use_replica
 from bluelog.emails import send_new_comment_email, send_new_reply_email
 from bluelog.extensions import db
+from bluelog.feeds import atom_feed, sitemap, sitemap_index, post_urls, cached_xml, site_url
 from bluelog.forms import CommentForm, AdminCommentForm
-from bluelog.models import Post, Category, Comment
+from bluelog.models import Post, Comment
+from bluelog.pagination import paginate
+from bluelog.querybudget import query_budget
+from bluelog.rendering import RENDER_VERSION, render_body
+from bluelog.search import search_posts
 from bluelog.utils import redirect_back
 
 
 blog_bp = Blueprint('blog', __name__)
+blog_bp.before_request(use_replica)
 
 
 @blog_bp.route('/')
+@query_budget(2)
+@cache_page('index')
 def index():
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BLOG_POST_PER_PAGE']
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(page, per_page=per_page)
+    total = sum(category.post_count for category in get_categories())
+    query = Post.query.options(db.defer(Post.body), db.joinedload(Post.category))
+    pagination = paginate(query, Post, per_page, total=total)
     posts = pagination.items
     return render_template('blog/index.html', pagination=pagination, posts=posts)
 
 
 @blog_bp.route('/about/')
+@query_budget(1)
+@cache_page()
 def about():
     return render_template('blog/about.html')
 
 
+@blog_bp.route('/feed.xml')
+def feed():
+    def generate():
+        admin = get_admin()
+        posts = Post.query.options(db.defer(Post.body), db.undefer(Post.body_html), db.joinedload(Post.category)) \
+            .order_by(Post.timestamp.desc()).limit(current_app.config['BLOG_FEED_ITEMS'])
+        return atom_feed(admin.blog_title, admin.blog_sub_title, site_url('.index'), site_url('.feed'), posts)
+    return cached_xml('feed', generate, 'application/atom+xml')
+
+
+@blog_bp.route('/category/<int:category_id>/feed.xml')
+def category_feed(category_id):
+    # 分类不存在时 404 也不查询数据库
+    category = next((c for c in get_categories() if c.id == category_id), None)
+    if category is None:
+        abort(404)
+
+    def generate():
+        admin = get_admin()
+        posts = Post.query.filter_by(category_id=category_id) \
+            .options(db.defer(Post.body), db.undefer(Post.body_html), db.joinedload(Post.category)) \
+            .order_by(Post.timestamp.desc()).limit(current_app.config['BLOG_FEED_ITEMS'])
+        return atom_feed(f'{admin.blog_title} - {category.name}', admin.blog_sub_title,
+                         site_url('.show_category', category_id=category_id),
+                         site_url('.category_feed', category_id=category_id), posts)
+    return cached_xml(f'category-{category_id}', generate, 'application/atom+xml')
+
+
+@blog_bp.route('/sitemap.xml')
+def sitemap_xml():
+    # 单个网站地图最多 BLOG_SITEMAP_SIZE 个地址，文章更多时返回索引，由 sitemap-<页码>.xml 分页列出
+    size = current_app.config['BLOG_SITEMAP_SIZE']
+    total = sum(category.post_count for category in get_categories())
+    if total > size:
+        return cached_xml('sitemap', lambda: sitemap_index(-(-total // size)))
+
+    def generate():
+        pages = [(site_url('.index'), None), (site_url('.about'), None)]
+        pages += [(site_url('.show_category', category_id=category.id), None)
+                  for category in get_categories()]
+        return sitemap(chain(pages, post_urls(0, size)))
+    return cached_xml('sitemap', generate)
+
+
+@blog_bp.route('/sitemap-<int:page>.xml')
+def sitemap_page(page):
+    size = current_app.config['BLOG_SITEMAP_SIZE']
+    total = sum(category.post_count for category in get_categories())
+    if page < 1 or (page - 1) * size >= total:
+        abort(404)
+    return cached_xml(f'sitemap-{page}', lambda: sitemap(post_urls((page - 1) * size, size)))
+
+
 @blog_bp.route('/category/<int:category_id>/')
+@query_budget(2)
+@cache_page('category-{category_id}')
 def show_category(category_id):
-    category = Category.query.get_or_404(category_id)
-    page = request.args.get('page', 1, type=int)
+    # 分类名和文章数取自站点缓存
+    category = next((c for c in get_categories() if c.id == category_id), None)
+    if category is None:
+        abort(404)
     per_page = current_app.config['BLOG_POST_PER_PAGE']
-    pagination = Post.query.with_parent(category).order_by(Post.timestamp.desc()).paginate(page, per_page)
+    query = Post.query.filter_by(category_id=category_id).options(db.defer(Post.body), db.joinedload(Post.category))
+    pagination = paginate(query, Post, per_page, total=category.post_count)
     posts = pagination.items
     return render_template('blog/category.html', category=category, pagination=pagination, posts=posts)
 
 
 @blog_bp.route('/post/<int:post_id>/', methods=['GET', 'POST'])
+@query_budget(6)
+@cache_page('post-{post_id}')
 def show_post(post_id):
-    post = Post.query.get_or_404(post_id)
-    page = request.args.get('page', 1, type=int)
+    # 正文只在还没有按当前版本渲染时才需要读取
+    post = Post.query.options(db.defer(Post.body), db.undefer(Post.body_html)).get_or_404(post_id)
+    body_html = post.body_html if post.render_version == RENDER_VERSION else render_body(post.body)
     per_page = current_app.config['BLOG_COMMENT_PER_PAGE']
-    pagination = Comment.query.with_parent(post).order_by(Comment.timestamp.desc()).paginate(page, per_page)
-    comments = pagination.items
+    # 按顶层评论分页，每页的回复再用一次查询取出
+    roots = Comment.query.with_parent(post).filter(Comment.replied_id.is_(None))
+    pagination = paginate(roots, Comment, per_page)
+    comments = Comment.load_threads(pagination.items)
 
     if current_user.is_authenticated:
         form = AdminCommentForm()
@@ -61,16 +141,48 @@ def show_post(post_id):
         comment = Comment(author=author, email=email, body=body, from_admin=from_admin, post=post, read=read)
         replied_id = request.args.get('reply')
         if replied_id:
-            replied_comment = Comment.query.get_or_404(replied_id)
+            replied_comment = Comment.query.filter_by(id=replied_id, post_id=post.id).first_or_404()
             comment.replied = replied_comment
-            send_new_reply_email(replied_comment)
+        post.comment_count = Post.comment_count + 1
         db.session.add(comment)
+        db.session.flush()
+        comment.set_path()
         db.session.commit()
+        page_cache.purge(f'post-{post.id}')
         flash('评论发表成功', 'success')
+        if comment.replied:
+            send_new_reply_email(comment.replied)
         if not current_user.is_authenticated:  # 访客发表评论，通知管理员
             send_new_comment_email(post)
         return redirect(url_for('.show_post', post_id=post_id))
-    return render_template('blog/post.html', post=post, pagination=pagination, form=form, comments=comments)
+    return render_template('blog/post.html', post=post, body_html=body_html, pagination=pagination, form=form,
+                           comments=comments)
+
+
+@blog_bp.route('/csrf-token')
+def csrf_token():
+    '''整页缓存的页面中 CSRF 令牌是占位符，表单提交前从这里获取当前会话的令牌，见 static/js/script.js'''
+    response = jsonify(csrf_token=generate_csrf())
+    response.cache_control.no_store = True
+    return response
+
+
+@blog_bp.route('/search/')
+def search():
+    q = request.args.get('q', '').strip()
+    if not q:
+        flash('请输入搜索内容', 'warning')
+        return redirect_back()
+    page = request.args.get('page', 1, type=int)
+    per_page = current_app.config['BLOG_SEARCH_RESULT_PER_PAGE']
+    post_ids, total = search_posts(q, (page - 1) * per_page, per_page)
+    posts = []
+    if post_ids:
+        posts = Post.query.options(db.defer(Post.body), db.joinedload(Post.category)) \
+            .filter(Post.id.in_(post_ids)).all()
+        posts.sort(key=lambda post: post_ids.index(post.id))
+    pagination = Pagination(None, page, per_page, total, posts)
+    return render_template('blog/search.html', q=q, pagination=pagination, posts=posts)
 
 
 @blog_bp.route('/reply/comment/<int:comment_id>/')
@@ -0,0 +1,435 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+from types import SimpleNamespace
+
+from flask import current_app, request, session, g
+from flask_login import current_user
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy.orm import make_transient_to_detached
+
+from bluelog.database import use_primary
+from bluelog.extensions import db
+
+
+def _snapshot(obj):
+    # 只保存列值，缓存的数据不和任何数据库会话绑定
+    return {column.name: getattr(obj, column.name) for column in obj.__table__.columns}
+
+
+def _stamp_path(name):
+    return os.path.join(current_app.config['BLOG_CACHE_DIR'], name)
+
+
+def read_stamp(name):
+    '''读取 BLOG_CACHE_DIR 下的版本号文件，不存在时返回空字符串'''
+    try:
+        with open(_stamp_path(name)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return ''
+
+
+def stamp_mtime(name):
+    '''版本号文件的修改时间，不存在时返回 None'''
+    try:
+        return os.stat(_stamp_path(name)).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def bump_stamp(name):
+    '''写入新的版本号，先写临时文件再替换，其他进程不会读到写了一半的内容'''
+    path = _stamp_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(uuid.uuid4().hex)
+    os.replace(tmp_path, path)
+
+
+class SiteCache:
+    '''
+    进程内缓存每个页面都要用到的公共数据：管理员资料、分类列表和链接列表。
+    版本号保存在 BLOG_CACHE_DIR 下的一个小文件里，gunicorn 的多个 worker 共享，
+    后台修改这些数据后调用 expire() 更新版本号，各 worker 在下一次读取时丢弃旧数据。
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._values = {}
+
+    def version(self):
+        return read_stamp('version')
+
+    def get(self, key, loader):
+        version = self.version()
+        with self._lock:
+            if version != self._version:
+                self._values.clear()
+                self._version = version
+            if key in self._values:
+                return self._values[key]
+        with use_primary():
+            value = loader()
+        with self._lock:
+            if version == self._version:
+                self._values[key] = value
+        return value
+
+    def expire(self):
+        bump_stamp('version')
+        with self._lock:
+            self._values.clear()
+            self._version = None
+
+
+site_cache = SiteCache()
+
+
+def _load_admin():
+    from bluelog.models import Admin
+    admin = Admin.query.first()
+    return _snapshot(admin) if admin else None
+
+
+def _load_categories():
+    from bluelog.models import Category
+    return [_snapshot(category) for category in Category.query.order_by(Category.name)]
+
+
+def _load_links():
+    from bluelog.models import Link
+    return [_snapshot(link) for link in Link.query.order_by(Link.name)]
+
+
+def get_admin():
+    '''管理员资料的只读副本，未初始化时返回 None'''
+    row = site_cache.get('admin', _load_admin)
+    return SimpleNamespace(**row) if row else None
+
+
+def get_categories():
+    '''按名称排序的分类只读副本'''
+    return [SimpleNamespace(**row) for row in site_cache.get('categories', _load_categories)]
+
+
+def get_links():
+    '''按名称排序的链接只读副本'''
+    return [SimpleNamespace(**row) for row in site_cache.get('links', _load_links)]
+
+
+def load_admin(user_id):
+    '''
+    给 Flask-Login 使用，返回绑定到当前会话的 Admin 对象。
+    命中缓存时直接由快照构造对象并 merge 进会话，不产生查询，视图中修改后照常提交即可。
+    '''
+    from bluelog.models import Admin
+    row = site_cache.get('admin', _load_admin)
+    if row is None or row['id'] != user_id:
+        return Admin.query.get(user_id)
+    admin = Admin(**row)
+    make_transient_to_detached(admin)
+    return db.session.merge(admin, load=False)
+
+
+class MemoryBackend:
+    '''进程内 LRU 缓存，按页面字节数总和限制大小，每个 worker 各自一份'''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = entry
+            self.size += len(entry['body'])
+            while self.size > self.max_size and self._entries:
+                self._discard(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry['body'])
+
+    def sweep(self):
+        '''删除过期的页面，返回删除的页面数'''
+        now = time.time()
+        with self._lock:
+            expired = [key for key, entry in self._entries.items() if entry['expires'] < now]
+            for key in expired:
+                self._discard(key)
+        return len(expired)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'size': self.size}
+
+
+class FileSystemBackend:
+    '''
+    每个页面存为一个文件，同一台机器上的所有 gunicorn worker 共享。
+    文件第一行是 JSON 格式的元数据，之后是页面内容；不使用 pickle，目录中的文件被改动也不会执行任意代码。
+    写入时每隔 SWEEP_INTERVAL 秒清理一次：删除超过 timeout 的文件，总大小超过 max_size 时从最旧的开始删除。
+    '''
+
+    SWEEP_INTERVAL = 60  # 秒
+
+    def __init__(self, path, max_size, timeout):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self._last_sweep = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._file(key), 'rb') as f:
+                entry = json.loads(f.readline())
+                entry['body'] = f.read().decode()
+                return entry
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def set(self, key, entry):
+        metadata = {name: value for name, value in entry.items() if name != 'body'}
+        path = self._file(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(metadata).encode() + b'\n')
+            f.write(entry['body'].encode())
+        os.replace(tmp_path, path)
+        if time.monotonic() - self._last_sweep >= self.SWEEP_INTERVAL:
+            self.sweep()
+
+    def delete(self, key):
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def sweep(self):
+        '''删除过期的文件（包括写了一半遗留的临时文件），再按修改时间从旧到新删除超出大小上限的部分，返回删除的文件数'''
+        self._last_sweep = time.monotonic()
+        expires = time.time() - self.timeout
+        removed = 0
+        files = []
+        for entry in os.scandir(self.path):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if not entry.is_file():
+                continue
+            if stat.st_mtime < expires:
+                removed += self._remove(entry.path)
+            else:
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(file_size for mtime, file_size, path in files)
+        for mtime, file_size, path in sorted(files):
+            if size <= self.max_size:
+                break
+            removed += self._remove(path)
+            size -= file_size
+        return removed
+
+    def stats(self):
+        files = [entry for entry in os.scandir(self.path) if entry.is_file()]
+        return {'entries': len(files), 'size': sum(entry.stat().st_size for entry in files)}
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    '''
+    模板编译结果保存在目录中，新启动的 worker 直接加载，不用重新解析和编译模板。
+    缓存按模板源码的校验和失效；多个 worker 可能同时写入，先写临时文件再替换，不会读到写了一半的文件。
+    '''
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(directory)
+
+    def dump_bytecode(self, bucket):
+        path = self._get_cache_filename(bucket)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(tmp_path, path)
+        except OSError:
+            # 缓存目录不可写时只是每次重新编译
+            pass
+
+
+def compile_templates(app):
+    '''加载全部 HTML 模板，编译结果留在 jinja 环境中，配置了 bytecode_cache 时同时写入缓存目录。返回模板数'''
+    names = [name for name in app.jinja_env.list_templates() if name.endswith('.html')]
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+class PageCache:
+    '''
+    匿名访客的整页缓存，BLOG_PAGE_CACHE 为 'memory' 或 'filesystem' 时启用。
+
+    每个缓存页面带有若干标签（如 post-1、category-2、index），标签的版本号存放在
+    BLOG_CACHE_DIR/tags 下，purge() 更新标签版本号即让带这个标签的页面全部失效；
+    所有页面还依赖 site_cache 的版本号，分类、链接和博客设置变化时整站失效。
+    '''
+
+    # 允许出现在缓存键中的查询参数，带有其他参数的请求不走缓存
+    ALLOWED_ARGS = {'page', 'before', 'after'}
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        kind = app.config['BLOG_PAGE_CACHE']
+        if kind == 'memory':
+            self.backend = MemoryBackend(app.config['BLOG_PAGE_CACHE_MAX_SIZE'])
+        elif kind == 'filesystem':
+            self.backend = FileSystemBackend(os.path.join(app.config['BLOG_CACHE_DIR'], 'pages'),
+                                             app.config['BLOG_PAGE_CACHE_MAX_SIZE'], app.config['BLOG_PAGE_CACHE_TIMEOUT'])
+        elif kind:
+            raise ValueError(f'Unknown BLOG_PAGE_CACHE backend: {kind}')
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def generations(self, tags):
+        return [site_cache.version()] + [read_stamp(f'tags/{tag}') for tag in ('all',) + tuple(tags)]
+
+    def get(self, key, generations):
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+        if entry['generations'] != generations or entry['expires'] < time.time():
+            self.backend.delete(key)
+            return None
+        return entry
+
+    def set(self, key, generations, body):
+        '''保存页面并返回 ETag，ETag 只在保存时计算一次，命中时直接使用'''
+        entry = {
+            'body': body,
+            'etag': hashlib.md5(body.encode()).hexdigest(),
+            'generations': generations,
+            'expires': time.time() + current_app.config['BLOG_PAGE_CACHE_TIMEOUT'],
+        }
+        self.backend.set(key, entry)
+        return entry['etag']
+
+    def purge(self, *tags):
+        '''让带有任一给定标签的缓存页面失效'''
+        if not self.enabled:
+            return
+        for tag in tags:
+            bump_stamp(f'tags/{tag}')
+
+    def clear(self):
+        self.purge('all')
+
+    def sweep(self):
+        '''删除过期的页面，返回删除数；memory 后端只能清理当前进程'''
+        return self.backend.sweep() if self.enabled else 0
+
+    def stats(self):
+        stats = {'backend': current_app.config['BLOG_PAGE_CACHE'], 'pid': os.getpid(),
+                 'hits': self.hits, 'misses': self.misses}
+        if self.enabled:
+            stats.update(self.backend.stats())
+        return stats
+
+
+page_cache = PageCache()
+
+
+# 整页缓存和静态导出的页面中代替 CSRF 令牌
+CSRF_PLACEHOLDER = 'csrf-token-placeholder'
+
+
+def _cacheable_request():
+    return (request.method == 'GET'
+            and set(request.args) <= PageCache.ALLOWED_ARGS
+            and '_flashes' not in session
+            and not current_user.is_authenticated)
+
+
+def defer_csrf_token():
+    '''
+    本次请求渲染的 CSRF 令牌都输出为 CSRF_PLACEHOLDER，页面内容不依赖访客的会话，也不会因此写入会话 cookie。
+    static/js/script.js 在提交带占位符的表单前向 blog.csrf_token 获取当前会话的令牌。
+    '''
+    setattr(g, current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'), CSRF_PLACEHOLDER)
+
+
+def cache_page(*tags):
+    '''
+    缓存匿名访客看到的页面，tags 可以引用视图参数，如 cache_page('post-{post_id}')。
+    页面中的 CSRF 令牌输出为占位符，见 defer_csrf_token()。同一页面每次返回的内容相同，
+    ETag 保存在缓存中，压缩结果可以按 ETag 复用，条件请求也能返回 304。
+    '''
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(**kwargs):
+            if not page_cache.enabled or not _cacheable_request():
+                return f(**kwargs)
+
+            defer_csrf_token()
+            key = '|'.join([
+                request.endpoint,
+                repr(sorted(kwargs.items())),
+                repr(sorted(request.args.items(multi=True))),
+                current_app.config['BLOG_THEME'],
+            ])
+            generations = page_cache.generations([tag.format(**kwargs) for tag in tags])
+            entry = page_cache.get(key, generations)
+            if entry is not None:
+                page_cache.hits += 1
+                response = current_app.response_class(entry['body'], mimetype='text/html')
+                response.set_etag(entry['etag'])
+                response.headers['X-Page-Cache'] = 'HIT'
+                return response
+
+            page_cache.misses += 1
+            response = current_app.make_response(f(**kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                response.set_etag(page_cache.set(key, generations, response.get_data(as_text=True)))
+            response.headers['X-Page-Cache'] = 'MISS'
+            return response
+        return decorated_function
+    return decorator
@@ -0,0 +1,88 @@
+import gzip
+
+from flask import request
+
+from bluelog.caches import MemoryBackend
+
+try:
+    import brotli
+except ImportError:  # brotli 是可选依赖，没有安装时只使用 gzip
+    brotli = None
+
+
+class Compressor:
+    '''
+    按 Accept-Encoding 用 brotli 或 gzip 压缩文本响应。
+    GET 请求的响应按未压缩内容的 MD5 生成 ETag，压缩后的 ETag 加上编码名后缀，并处理 If-None-Match。
+    整页缓存的页面和 public 缓存的响应，压缩结果按 (ETag, 编码) 保存在进程内的 LRU 缓存中，
+    同样的页面再次命中时不用重新压缩。
+    '''
+
+    def __init__(self, app=None):
+        self.variants = None
+        self.config = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['BLOG_COMPRESS']:
+            return
+        self.config = app.config
+        self.variants = MemoryBackend(app.config['BLOG_COMPRESS_CACHE_SIZE'])
+        app.after_request(self.compress_response)
+
+    def _compressible(self, response):
+        return (response.status_code == 200
+                and not response.direct_passthrough
+                and not response.is_streamed
+                and response.content_encoding is None
+                and 'Content-Range' not in response.headers
+                and not response.cache_control.no_transform
+                and response.mimetype in self.config['BLOG_COMPRESS_MIMETYPES'])
+
+    def _negotiate(self):
+        accepted = request.accept_encodings
+        candidates = [encoding for encoding in ('br', 'gzip')
+                      if accepted[encoding] and (encoding != 'br' or brotli is not None)]
+        if not candidates:
+            return None
+        # 质量值相同时优先 brotli
+        return max(candidates, key=lambda encoding: accepted[encoding])
+
+    def _compress(self, data, encoding):
+        if encoding == 'br':
+            return brotli.compress(data, quality=self.config['BLOG_COMPRESS_BR_QUALITY'])
+        return gzip.compress(data, self.config['BLOG_COMPRESS_LEVEL'], mtime=0)
+
+    def compress_response(self, response):
+        if not self._compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+        conditional = request.method in ('GET', 'HEAD')
+        if conditional and response.get_etag()[0] is None:
+            response.add_etag()
+
+        encoding = self._negotiate()
+        data = response.get_data()
+        if encoding is None or len(data) < self.config['BLOG_COMPRESS_MIN_SIZE']:
+            return response.make_conditional(request) if conditional else response
+
+        etag, weak = response.get_etag()
+        cacheable = etag is not None and ('X-Page-Cache' in response.headers or response.cache_control.public)
+        key = f'{etag}:{encoding}'
+        entry = self.variants.get(key) if cacheable else None
+        if entry is None:
+            entry = {'body': self._compress(data, encoding)}
+            if cacheable:
+                self.variants.set(key, entry)
+        response.set_data(entry['body'])
+        response.content_encoding = encoding
+        if etag is not None:
+            response.set_etag(f'{etag}-{encoding}', weak)
+        return response.make_conditional(request) if conditional else response
+
+    def stats(self):
+        return self.variants.stats() if self.variants is not None else {}
+
+
+compressor = Compressor()
@@ -11,7 +11,38 @@ class BaseConfig:
     DEBUG_TB_INTERCEPT_REDIRECTS = False
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_RECORD_QUERIES = True
+    # 记录每条 SQL 供请求结束时的 N+1 检查和查询预算检查使用，有额外开销，只在开发和测试环境中打开
+    SQLALCHEMY_RECORD_QUERIES = False
+    BLOG_DEBUG_TOOLBAR = False
+    # 只读副本，配置后匿名访客对博客前台的 GET 请求从副本读取，写入和后台请求仍然使用主库
+    BLOG_REPLICA_DATABASE_URI = os.getenv('BLOG_REPLICA_DATABASE_URI')
+    # 按数据库类型设置的引擎参数，见 bluelog/database.py。gunicorn 的 worker 数同样读取 WEB_CONCURRENCY
+    BLOG_WEB_WORKERS = int(os.getenv('WEB_CONCURRENCY', 6))
+    BLOG_WEB_THREADS = int(os.getenv('BLOG_WEB_THREADS', 1))
+    # 所有 worker 合计的 MySQL 连接数上限，MySQL 默认的 max_connections 为 151
+    BLOG_DB_MAX_CONNECTIONS = int(os.getenv('BLOG_DB_MAX_CONNECTIONS', 120))
+    BLOG_DB_POOL_RECYCLE = 280  # 秒，早于 MySQL 和中间代理断开空闲连接
+    # WAL 模式下读写互不阻塞，synchronous=NORMAL 在 WAL 模式下只在检查点时同步到磁盘
+    BLOG_SQLITE_PRAGMAS = {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'mmap_size': 256 * 1024 * 1024,
+        'busy_timeout': 5000,   # 毫秒
+    }
+
+    # 按端点统计请求数、延迟、SQL 和模板渲染耗时，见 bluelog/metrics.py。
+    # /metrics 需要登录管理员，或者带上 Authorization: Bearer <BLOG_METRICS_TOKEN>
+    BLOG_METRICS = True
+    BLOG_METRICS_TOKEN = os.getenv('BLOG_METRICS_TOKEN')
+    BLOG_METRICS_FLUSH_INTERVAL = 5  # 秒，每个 worker 写入统计文件的最短间隔
+    BLOG_METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # 延迟分布的区间上界，秒
+    # 响应中加上 Server-Timing 头（db、render、total），浏览器开发者工具中可以看到耗时分布
+    BLOG_SERVER_TIMING = os.getenv('BLOG_SERVER_TIMING') == '1'
+
+    # 同一形状的语句在一个请求中执行达到这个次数时记录为 N+1 查询
+    BLOG_QUERY_REPEAT_THRESHOLD = 3
+    # 视图超出 query_budget 声明的语句数时：'log' 记录警告，'raise' 抛出 QueryBudgetExceeded
+    BLOG_QUERY_BUDGET_ACTION = os.getenv('BLOG_QUERY_BUDGET_ACTION', 'log')
 
     CKEDITOR_SERVE_LOCAL = True
     CKEDITOR_LANGUAGE = 'zh-cn'
@@ -19,6 +50,21 @@ class BaseConfig:
     CKEDITOR_FILE_UPLOADER = 'admin.upload_image'    # 处理图片上传的视图函数的url或端点值
     CKEDITOR_UPLOAD_PATH = os.path.join(basedir, 'uploads')
 
+    BLOG_UPLOAD_MAX_SIZE = 8 * 1024 * 1024
+    # 整个请求体的上限，按 Content-Length 在读取请求体之前检查，超出时直接返回 413，
+    # 不会先把整个请求体写入临时文件。最大的请求是图片上传，留出其他表单字段和 multipart 边界的余量
+    MAX_CONTENT_LENGTH = BLOG_UPLOAD_MAX_SIZE + 256 * 1024
+    # 上传图片后在后台进程池中生成的缩略图宽度，正文中插入 BLOG_UPLOAD_DISPLAY_WIDTH 宽的版本
+    BLOG_UPLOAD_WIDTHS = (480, 960, 1600)
+    BLOG_UPLOAD_DISPLAY_WIDTH = 960
+    BLOG_UPLOAD_QUALITY = 85
+    BLOG_UPLOAD_WORKERS = 2
+    # 上传文件的发送方式：None 由 Flask 发送，'nginx' 返回 X-Accel-Redirect，'apache' 返回 X-Sendfile。
+    # nginx 需要配置对应的 internal location，如 location /_uploads/ { internal; alias /path/to/uploads/; }
+    BLOG_UPLOAD_SENDFILE = os.getenv('BLOG_UPLOAD_SENDFILE')
+    BLOG_UPLOAD_ACCEL_PREFIX = '/_uploads/'
+    BLOG_UPLOAD_FALLBACK_MAX_AGE = 60  # 秒，缩略图生成之前返回原图时的缓存时间
+
     MAIL_SERVER = os.getenv('MAIL_SERVER')
     MAIL_PORT = 465
     MAIL_USE_SSL = True
@@ -26,9 +72,27 @@ class BaseConfig:
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = ('admin', MAIL_USERNAME)
 
+    # 'thread' 在每个进程中用一个后台线程发送发件箱中的邮件，'external' 只写入发件箱，由 flask mail-worker 发送
+    BLOG_MAIL_WORKER = os.getenv('BLOG_MAIL_WORKER', 'thread')
+    BLOG_MAIL_BATCH_SIZE = 50
+    BLOG_MAIL_MAX_ATTEMPTS = 5
+    BLOG_MAIL_RETRY_DELAY = 60   # 秒，每次失败后加倍
+    BLOG_MAIL_POLL_INTERVAL = 30     # 秒
+    BLOG_MAIL_COALESCE_WINDOW = 600  # 秒，同一篇文章的新评论通知在这段时间内最多发送一封
+
     BLOG_POST_PER_PAGE = 10
     BLOG_MANAGE_POST_PER_PAGE = 15
     BLOG_COMMENT_PER_PAGE = 10
+    # 'offset' 为页码分页，'keyset' 为按 (timestamp, id) 的游标分页，带 ?page= 的链接总是按页码分页
+    BLOG_PAGINATION = os.getenv('BLOG_PAGINATION', 'offset')
+    BLOG_SEARCH_RESULT_PER_PAGE = 20
+    # 站点的根地址，如 https://example.com，订阅源和网站地图中的完整链接按它生成，部署时需要设置
+    BLOG_BASE_URL = os.getenv('BLOG_BASE_URL', 'http://localhost/')
+    BLOG_FEED_ITEMS = 20
+    BLOG_FEED_MAX_AGE = 300     # 秒
+    BLOG_SITEMAP_SIZE = 50000   # 网站地图协议规定单个文件最多 50000 个地址
+    # 全文搜索索引：'fts5' 使用 SQLite FTS5，'table' 使用普通表（MySQL），'auto' 自动选择
+    BLOG_SEARCH_BACKEND = os.getenv('BLOG_SEARCH_BACKEND', 'auto')
 
     # {'主题名': 'css文件名'}
     BLOG_THEMES = {
@@ -37,17 +101,64 @@ class BaseConfig:
     }
     BLOG_THEME = list(BLOG_THEMES.keys())[0]
 
+    # 响应压缩：浏览器支持时使用 brotli（需要安装 brotli），否则使用 gzip，小于 BLOG_COMPRESS_MIN_SIZE 字节的响应不压缩
+    BLOG_COMPRESS = True
+    BLOG_COMPRESS_MIN_SIZE = 500
+    BLOG_COMPRESS_LEVEL = 6
+    BLOG_COMPRESS_BR_QUALITY = 5
+    BLOG_COMPRESS_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/xml', 'application/json',
+                               'application/javascript', 'application/xml', 'application/atom+xml',
+                               'application/rss+xml'}
+    BLOG_COMPRESS_CACHE_SIZE = 32 * 1024 * 1024    # 缓存的压缩结果总字节数上限
+
+    # 使用 flask assets build 生成的清单，静态文件的 URL 带上内容指纹并长期缓存
+    BLOG_ASSETS_MANIFEST = True
+
+    # 缓存目录，存放多个 worker 共享的缓存版本号等
+    BLOG_CACHE_DIR = os.path.join(basedir, 'cache')
+    # 模板编译结果缓存在 BLOG_CACHE_DIR/templates，新启动的 worker 不用重新编译；模板修改后按源码校验和自动失效
+    BLOG_TEMPLATE_CACHE = True
+    # 创建应用时加载全部模板，配合 gunicorn --preload 只在主进程中加载一次
+    BLOG_PRELOAD_TEMPLATES = False
+
+    # 匿名访客的整页缓存：None 关闭，'memory' 为每个 worker 内的 LRU 缓存，'filesystem' 为多个 worker 共享的文件缓存
+    BLOG_PAGE_CACHE = os.getenv('BLOG_PAGE_CACHE')
+    BLOG_PAGE_CACHE_MAX_SIZE = 64 * 1024 * 1024    # 页面总字节数上限，memory 后端为每个 worker 各自的上限
+    BLOG_PAGE_CACHE_TIMEOUT = 300   # 秒，文章列表中的评论数等只在超时后更新
+
 
 class DevelopmentConfig(BaseConfig):
+    SQLALCHEMY_RECORD_QUERIES = True
+    BLOG_DEBUG_TOOLBAR = True
+    BLOG_SERVER_TIMING = True
+    BLOG_BASE_URL = os.getenv('BLOG_BASE_URL', 'http://localhost:5000/')
+    # 开发时修改静态文件后不需要重新构建
+    BLOG_ASSETS_MANIFEST = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'data-dev.db')
 
 
+class TestingConfig(BaseConfig):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    SQLALCHEMY_RECORD_QUERIES = True
+    # 测试中超出 query_budget 直接失败；整页缓存命中时不执行查询，关闭后才能测到视图本身
+    BLOG_QUERY_BUDGET_ACTION = 'raise'
+    BLOG_PAGE_CACHE = None
+    BLOG_ASSETS_MANIFEST = False
+    BLOG_TEMPLATE_CACHE = False
+    # 测试中直接调用 deliver_pending() 发送，不启动发送线程
+    BLOG_MAIL_WORKER = 'external'
+
+
 class ProductionConfig(BaseConfig):
+    BLOG_PRELOAD_TEMPLATES = True
     SQLALCHEMY_DATABASE_URI = os.getenv('SQLALCHEMY_DATABASE_URI', 'sqlite:///' + os.path.join(basedir, 'data.db'))
 
 
 config = {
     'base': BaseConfig,
     'development': DevelopmentConfig,
+    'testing': TestingConfig,
     'production': ProductionConfig
 }
@@ -0,0 +1,113 @@
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, request
+from flask_login import current_user
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+
+# SQLALCHEMY_BINDS 中只读副本的键名
+REPLICA = 'replica'
+
+
+def engine_profile(sa_url, config):
+    '''
+    按数据库类型返回 create_engine 的参数。每个 gunicorn worker 各有一个连接池，
+    池大小为每个 worker 的线程数加一（发邮件的后台线程），MySQL 的溢出连接数按所有 worker 共用的连接上限分配。
+    '''
+    pool_size = config['BLOG_WEB_THREADS'] + 1
+    if sa_url.drivername.startswith('sqlite'):
+        if sa_url.database in (None, '', ':memory:'):
+            return {}
+        # 默认的 NullPool 每次取连接都重新打开文件，PRAGMA 和 mmap 都要重新设置，改用连接池复用
+        return {
+            'poolclass': QueuePool,
+            'pool_size': pool_size,
+            'max_overflow': 10,
+            'connect_args': {'check_same_thread': False},
+            'sqlite_pragmas': config['BLOG_SQLITE_PRAGMAS'],
+        }
+    if sa_url.drivername.startswith('mysql'):
+        max_overflow = max(0, config['BLOG_DB_MAX_CONNECTIONS'] // config['BLOG_WEB_WORKERS'] - pool_size)
+        return {
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'pool_recycle': config['BLOG_DB_POOL_RECYCLE'],
+            'pool_pre_ping': True,
+            'pool_timeout': 10,
+        }
+    return {}
+
+
+def _pragma_listener(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+    return set_pragmas
+
+
+class RoutingSession(SignallingSession):
+    '''
+    配置了只读副本且 g.read_replica 为真时，查询发往副本；flush 和 UPDATE / DELETE / INSERT 语句总是发往主库。
+    '''
+
+    def get_bind(self, mapper=None, clause=None):
+        if (has_app_context() and g.get('read_replica') and not self._flushing
+                and not isinstance(clause, UpdateBase)):
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    '''按数据库类型调整引擎参数，会话使用 RoutingSession'''
+
+    def init_app(self, app):
+        replica_uri = app.config['BLOG_REPLICA_DATABASE_URI']
+        if replica_uri:
+            app.config['SQLALCHEMY_BINDS'] = dict(app.config.get('SQLALCHEMY_BINDS') or {}, **{REPLICA: replica_uri})
+        super().init_app(app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # 先写入，Flask-SQLAlchemy 的默认值不再覆盖；SQLALCHEMY_ENGINE_OPTIONS 仍然优先
+        options.update(engine_profile(sa_url, app.config))
+        super().apply_driver_hacks(app, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop('sqlite_pragmas', None)
+        engine = super().create_engine(sa_url, engine_opts)
+        if pragmas:
+            event.listen(engine, 'connect', _pragma_listener(pragmas))
+        return engine
+
+
+def use_replica():
+    '''
+    before_request 钩子：只读请求的查询发往只读副本。
+    登录的管理员仍然读取主库，刚修改的内容不受复制延迟影响立即可见。
+    '''
+    if (request.method in ('GET', 'HEAD') and REPLICA in (current_app.config.get('SQLALCHEMY_BINDS') or {})
+            and not current_user.is_authenticated):
+        g.read_replica = True
+
+
+@contextmanager
+def use_primary():
+    '''
+    在只读请求中临时读取主库。按版本号长期缓存的数据（分类列表、订阅源等）必须从主库读取，
+    否则版本号更新后从落后的副本读到的旧数据会一直缓存到下一次更新。
+    '''
+    replica = has_app_context() and g.get('read_replica', False)
+    if replica:
+        g.read_replica = False
+    try:
+        yield
+    finally:
+        if replica:
+            g.read_replica = True
@@ -1,33 +1,177 @@
-from threading import Thread
+import os
+import smtplib
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
 from flask import url_for, current_app
 from flask_mail import Message
+from sqlalchemy import or_
+
+from bluelog.caches import get_admin
+from bluelog.extensions import db, mail
+from bluelog.models import Outbox
+
+
+def send_mail(subject, to, html, key=None):
+    '''
+    把邮件写入发件箱并提交，由 worker 发送。
+    给出 key 时，同一收件人还有未发送的同 key 邮件则不再重复写入；
+    窗口期内刚发送过同 key 的邮件，则新邮件推迟到窗口结束后再发。
+    同 key 的邮件正在被 worker 发送时不能再合并进去，按刚发送过处理。
+    '''
+    if not to:
+        return None
+    now = datetime.utcnow()
+    send_after = now
+    if key is not None:
+        pending = Outbox.query.filter_by(key=key, recipient=to, status='pending') \
+            .filter(_unlocked(now)).first()
+        if pending is not None:
+            return pending
+        window = timedelta(seconds=current_app.config['BLOG_MAIL_COALESCE_WINDOW'])
+        sending = Outbox.query.filter_by(key=key, recipient=to, status='pending') \
+            .filter(Outbox.locked_until >= now).first()
+        last = Outbox.query.filter_by(key=key, recipient=to, status='sent') \
+            .filter(Outbox.sent_at > now - window).order_by(Outbox.sent_at.desc()).first()
+        if sending is not None:
+            send_after = now + window
+        elif last is not None:
+            send_after = last.sent_at + window
+    outbox = Outbox(recipient=to, subject=subject, html=html, key=key, send_after=send_after)
+    db.session.add(outbox)
+    db.session.commit()
+    mail_worker.notify(current_app._get_current_object())
+    return outbox
+
+
+def _unlocked(now):
+    # 没有被领取，或者领取的 worker 没有在锁定期内发送完（进程退出等）
+    return or_(Outbox.locked_until.is_(None), Outbox.locked_until < now)
+
+
+def _claim(batch_size):
+    # 用随机 token 标记一批到期的邮件，多个进程同时发送时不会重复领取
+    now = datetime.utcnow()
+    unlocked = _unlocked(now)
+    ids = [row.id for row in db.session.query(Outbox.id)
+           .filter(Outbox.status == 'pending', Outbox.send_after <= now, unlocked)
+           .order_by(Outbox.id).limit(batch_size)]
+    if not ids:
+        return []
+    token = uuid.uuid4().hex
+    Outbox.query.filter(Outbox.id.in_(ids), unlocked).update(
+        {Outbox.lock_token: token, Outbox.locked_until: now + timedelta(minutes=5)}, synchronize_session=False)
+    db.session.commit()
+    return Outbox.query.filter_by(lock_token=token).order_by(Outbox.id).all()
+
+
+def _failed(outbox, error):
+    outbox.attempts += 1
+    outbox.last_error = str(error)
+    if outbox.attempts >= current_app.config['BLOG_MAIL_MAX_ATTEMPTS']:
+        outbox.status = 'failed'
+    else:
+        delay = current_app.config['BLOG_MAIL_RETRY_DELAY'] * 2 ** (outbox.attempts - 1)
+        outbox.send_after = datetime.utcnow() + timedelta(seconds=delay)
+
+
+def deliver_pending(batch_size=None):
+    '''领取一批到期的邮件，通过同一个 SMTP 连接发送，失败的按指数退避重试，返回处理的数量'''
+    outboxes = _claim(batch_size or current_app.config['BLOG_MAIL_BATCH_SIZE'])
+    if not outboxes:
+        return 0
+    try:
+        with mail.connect() as connection:
+            for outbox in outboxes:
+                try:
+                    connection.send(Message(outbox.subject, recipients=[outbox.recipient], html=outbox.html))
+                except (smtplib.SMTPException, OSError) as e:
+                    _failed(outbox, e)
+                else:
+                    outbox.status = 'sent'
+                    outbox.sent_at = datetime.utcnow()
+    except (smtplib.SMTPException, OSError) as e:
+        # 连接失败，这一批中还没发出的全部稍后重试
+        for outbox in outboxes:
+            if outbox.status == 'pending':
+                _failed(outbox, e)
+    for outbox in outboxes:
+        outbox.lock_token = None
+        outbox.locked_until = None
+    db.session.commit()
+    return len(outboxes)
+
+
+def deliver_all():
+    '''发送所有到期的邮件，返回处理的数量'''
+    total = 0
+    while True:
+        count = deliver_pending()
+        if not count:
+            return total
+        total += count
+
+
+class MailWorker:
+    '''
+    每个进程最多一个发送线程，写入发件箱后唤醒，另外每隔 BLOG_MAIL_POLL_INTERVAL 秒检查一次需要重试的邮件。
+    BLOG_MAIL_WORKER 为 'external' 时不启动线程，由 flask mail-worker 在独立进程中发送。
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def notify(self, app):
+        if app.config['BLOG_MAIL_WORKER'] != 'thread':
+            return
+        with self._lock:
+            # gunicorn fork 出的子进程不会继承父进程的线程
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, args=(app,), name='mail-worker', daemon=True)
+                self._thread.start()
+        self._event.set()
 
-from bluelog.extensions import mail
-from bluelog.models import Admin
+    def _run(self, app):
+        while True:
+            self._event.clear()
+            with app.app_context():
+                try:
+                    deliver_all()
+                except Exception:
+                    app.logger.exception('Mail worker failed')
+            self._event.wait(app.config['BLOG_MAIL_POLL_INTERVAL'])
 
 
-def _send_async_mail(app, message):
-    with app.app_context():
-        mail.send(message)
+mail_worker = MailWorker()
 
 
-def send_mail(subject, to, html):
-    app = current_app._get_current_object()
-    message = Message(subject, recipients=[to], html=html)
-    thr = Thread(target=_send_async_mail, args=[app, message])
-    thr.start()
-    return thr
+def run_worker(once=False):
+    '''flask mail-worker 使用：循环发送到期的邮件'''
+    while True:
+        count = deliver_all()
+        if count:
+            current_app.logger.info('Processed %d mails', count)
+        if once:
+            return
+        time.sleep(current_app.config['BLOG_MAIL_POLL_INTERVAL'])
+        db.session.remove()
 
 
 def send_new_comment_email(post):
-    admin = Admin.query.first()
+    admin = get_admin()
     post_url = url_for('blog.show_post', post_id=post.id, _external=True) + '#comments'
     body = f'''
                 <p>文章 <i>《{post.title}》</i> 有新的评论, 点击链接查看：</p>
                 <p><a href="{post_url}">{post_url}</a></P>
                 <p><small style="color: #868e96">不要回复此邮件</small></p>
             '''
-    send_mail(subject='新评论', to=admin.email, html=body)
+    send_mail(subject='新评论', to=admin.email if admin else None, html=body, key=f'new-comment:{post.id}')
 
 
 def send_new_reply_email(comment):
@@ -0,0 +1,264 @@
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import render_template
+
+from bluelog.caches import page_cache, defer_csrf_token, get_admin, get_categories, get_links
+from bluelog.extensions import db
+from bluelog.metrics import metrics
+from bluelog.models import Post, Comment
+from bluelog.rendering import RENDER_VERSION
+
+
+MANIFEST = '.export-manifest.json'
+ERROR_PAGES = ('400.html', '404.html', '500.html')
+CHUNK_SIZE = 20
+
+# 进程池中的 worker 状态，由 _init_worker 设置
+_app = None
+_worker = None
+
+
+def page_file(path, page=1):
+    '''
+    URL 对应的文件：/category/1/ 的第一页为 category/1/index.html，第 n 页为 category/1/page-n.html。
+    导出的评论表单中 CSRF 令牌是占位符，提交前由 static/js/script.js 向应用的 /csrf-token 获取，
+    评论以 POST 提交到同一地址。nginx 可以这样配置，找不到文件的请求（包括 /csrf-token）和 POST 请求交给应用：
+
+        location / {
+            set $page_file index.html;
+            if ($arg_page) { set $page_file page-$arg_page.html; }
+            # 静态文件不接受 POST，nginx 返回 405，改由应用处理评论提交
+            error_page 405 = @app;
+            try_files $uri$page_file @app;
+        }
+    '''
+    directory = path.strip('/')
+    name = 'index.html' if page == 1 else f'page-{page}.html'
+    return f'{directory}/{name}' if directory else name
+
+
+def _digest(*parts):
+    return hashlib.sha256(json.dumps(parts, default=str, sort_keys=True).encode()).hexdigest()
+
+
+def _pages(count, per_page):
+    return max(1, -(-count // per_page))
+
+
+def _template_digest(app):
+    sha256 = hashlib.sha256()
+    template_folder = os.path.join(app.root_path, app.template_folder)
+    for root, dirs, files in os.walk(template_folder):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            sha256.update(os.path.relpath(path, template_folder).encode())
+            with open(path, 'rb') as f:
+                sha256.update(f.read())
+    return sha256.hexdigest()
+
+
+def site_digest(app, base_url):
+    '''每个页面都依赖的数据：侧边栏和页头用到的博客资料、分类、链接，以及模板、静态文件清单和主题'''
+    admin = get_admin()
+    return _digest(
+        vars(admin) if admin else None,
+        [vars(category) for category in get_categories()],
+        [vars(link) for link in get_links()],
+        _template_digest(app),
+        app.extensions['assets'].manifest,
+        app.config['BLOG_THEME'],
+        RENDER_VERSION,
+        base_url,
+    )
+
+
+def _comment_digests():
+    '''一次流式读取所有评论，返回 {文章 id: (评论摘要, 顶层评论数)}'''
+    digests = {}
+    query = db.session.query(Comment.post_id, Comment.id, Comment.path, Comment.replied_id, Comment.author,
+                             Comment.email, Comment.body, Comment.from_admin, Comment.timestamp) \
+        .order_by(Comment.post_id, Comment.path)
+    for row in query.yield_per(1000):
+        sha256, roots = digests.get(row.post_id) or (hashlib.sha256(), 0)
+        sha256.update(_digest(*row).encode())
+        digests[row.post_id] = (sha256, roots + (row.replied_id is None))
+    return {post_id: (sha256.hexdigest(), roots) for post_id, (sha256, roots) in digests.items()}
+
+
+def collect_pages(app, base_url):
+    '''
+    按数据库中的数据列出所有要导出的页面，返回 {文件: (URL 或 None, 指纹)}，URL 为 None 的是错误页面。
+    指纹只由页面用到的数据计算，不需要渲染：文章页依赖文章和它的全部评论，列表页依赖这一页的文章摘要和总页数，
+    所有页面都依赖 site_digest()。
+    '''
+    per_page = app.config['BLOG_POST_PER_PAGE']
+    comment_per_page = app.config['BLOG_COMMENT_PER_PAGE']
+    site = site_digest(app, base_url)
+    comments = _comment_digests()
+
+    pages = {name: (None, _digest(site, name)) for name in ERROR_PAGES}
+    pages[page_file('/about/')] = ('/about/', _digest(site, 'about'))
+
+    # 列表页按 (timestamp, id) 倒序排列，和 paginate() 一致
+    index_rows = []
+    category_rows = {category.id: [] for category in get_categories()}
+    query = db.session.query(Post.id, Post.title, Post.excerpt, Post.timestamp, Post.comment_count,
+                             Post.category_id, Post.can_comment, Post.body_html, Post.render_version) \
+        .order_by(Post.timestamp.desc(), Post.id.desc())
+    for row in query.yield_per(500):
+        summary = _digest(row.id, row.title, row.excerpt, row.timestamp, row.comment_count, row.category_id)
+        index_rows.append(summary)
+        category_rows.setdefault(row.category_id, []).append(summary)
+
+        comment_digest, roots = comments.get(row.id, (None, 0))
+        post_digest = _digest(site, summary, row.can_comment, row.body_html, row.render_version, comment_digest)
+        path = f'/post/{row.id}/'
+        for page in range(1, _pages(roots, comment_per_page) + 1):
+            url = path if page == 1 else f'{path}?page={page}'
+            pages[page_file(path, page)] = (url, _digest(post_digest, page))
+
+    def add_list(path, rows):
+        total = _pages(len(rows), per_page)
+        for page in range(1, total + 1):
+            url = path if page == 1 else f'{path}?page={page}'
+            chunk = rows[(page - 1) * per_page:page * per_page]
+            pages[page_file(path, page)] = (url, _digest(site, path, total, page, chunk))
+
+    add_list('/', index_rows)
+    for category_id, rows in category_rows.items():
+        if category_id is not None:
+            add_list(f'/category/{category_id}/', rows)
+    return pages
+
+
+def _init_worker(app, base_url):
+    '''
+    准备渲染用的应用：游标分页的链接没法对应到静态文件，固定按页码分页；
+    不注入调试工具栏，导出的页面也不写入整页缓存，不计入请求统计。
+    CSRF 令牌输出为占位符，导出时测试客户端的会话和令牌对访客无效。会修改 app，只在 flask export 中使用。
+    '''
+    global _app, _worker
+    app.config['BLOG_PAGINATION'] = 'offset'
+    page_cache.backend = None
+    metrics.enabled = False
+    toolbar = app.extensions.get('debugtoolbar')
+    if toolbar is not None and toolbar.process_request in app.before_request_funcs.get(None, []):
+        app.before_request_funcs[None].remove(toolbar.process_request)
+        app.after_request_funcs[None].remove(toolbar.process_response)
+    if defer_csrf_token not in app.before_request_funcs.setdefault(None, []):
+        app.before_request_funcs[None].append(defer_csrf_token)
+    _app = app
+    _worker = {'client': app.test_client(), 'base_url': base_url}
+
+
+def _init_forked_worker(base_url):
+    # fork 出的子进程继承了父进程中的 _app，不能复用父进程的数据库连接
+    with _app.app_context():
+        db.engine.dispose()
+    _init_worker(_app, base_url)
+
+
+def _render(directory, file, url, old_digest):
+    if url is None:
+        with _app.test_request_context(base_url=_worker['base_url']):
+            body = render_template(f'errors/{file}').encode()
+    else:
+        response = _worker['client'].get(url, base_url=_worker['base_url'])
+        if response.status_code != 200:
+            return file, None, f'{url} 返回 {response.status_code}'
+        body = response.get_data()
+
+    digest = hashlib.sha256(body).hexdigest()
+    path = os.path.join(directory, file)
+    # 指纹变化但渲染结果相同时不改写文件，nginx 和 CDN 看到的修改时间保持不变
+    if digest != old_digest or not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+        return file, digest, 'written'
+    return file, digest, 'unchanged'
+
+
+def _render_chunk(directory, jobs):
+    return [_render(directory, *job) for job in jobs]
+
+
+def _load_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def export_site(app, directory, workers=None, full=False, base_url='http://localhost/', log=print):
+    '''
+    把公开页面渲染为静态文件写入 directory。清单中记录每个文件的指纹和内容哈希，
+    再次导出时只渲染指纹变化的页面，并删除已经不存在的页面。返回 (渲染数, 写入数, 删除数, 错误列表)。
+    workers 大于 1 且系统支持 fork 时在进程池中渲染。需要在应用上下文之外调用。
+    '''
+    global _app
+    os.makedirs(directory, exist_ok=True)
+    old = {} if full else _load_manifest(directory)
+    with app.app_context():
+        pages = collect_pages(app, base_url)
+        db.engine.dispose()
+
+    manifest = {file: entry for file, entry in old.items() if file in pages}
+    jobs = [(file, url, old[file]['digest'] if file in old else None)
+            for file, (url, fingerprint) in sorted(pages.items())
+            if file not in old or old[file]['fingerprint'] != fingerprint
+            or not os.path.exists(os.path.join(directory, file))]
+    log(f'共 {len(pages)} 个页面，需要渲染 {len(jobs)} 个')
+
+    removed = 0
+    for file in old.keys() - pages.keys():
+        try:
+            os.remove(os.path.join(directory, file))
+            removed += 1
+        except FileNotFoundError:
+            pass
+
+    chunks = [jobs[i:i + CHUNK_SIZE] for i in range(0, len(jobs), CHUNK_SIZE)]
+    progress = {'done': 0, 'written': 0, 'errors': []}
+
+    def collect(results):
+        for chunk in results:
+            for file, digest, status in chunk:
+                if digest is None:
+                    progress['errors'].append(status)
+                    continue
+                manifest[file] = {'fingerprint': pages[file][1], 'digest': digest}
+                progress['written'] += status == 'written'
+            progress['done'] += len(chunk)
+            if progress['done'] % 1000 < CHUNK_SIZE or progress['done'] == len(jobs):
+                log(f'已渲染 {progress["done"]}/{len(jobs)}')
+
+    try:
+        if workers and workers > 1 and len(chunks) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            _app = app
+            with ProcessPoolExecutor(workers, multiprocessing.get_context('fork'),
+                                     initializer=_init_forked_worker, initargs=(base_url,)) as executor:
+                collect(executor.map(_render_chunk, [directory] * len(chunks), chunks))
+        else:
+            _init_worker(app, base_url)
+            collect(_render_chunk(directory, chunk) for chunk in chunks)
+    finally:
+        # 中途出错时也保存已经完成的部分，下次从这里继续
+        _save_manifest(directory, manifest)
+    return len(jobs), progress['written'], removed, progress['errors']
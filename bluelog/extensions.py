@@ -1,26 +1,31 @@
+import os
+
 from flask_bootstrap import Bootstrap
 from flask_ckeditor import CKEditor
 from flask_login import LoginManager
 from flask_mail import Mail
+from flask_migrate import Migrate
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import CSRFProtect
-from flask_debugtoolbar import DebugToolbarExtension
+
+from bluelog.configs import basedir
+from bluelog.database import RoutingSQLAlchemy
 
 bootstrap = Bootstrap()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 login_manager = LoginManager()
 csrf = CSRFProtect()
 ckeditor = CKEditor()
 mail = Mail()
 moment = Moment()
-toolbar = DebugToolbarExtension()
+# SQLite 不支持大部分 ALTER TABLE，迁移中用 batch 模式重建表
+migrate = Migrate(directory=os.path.join(basedir, 'migrations'), render_as_batch=True)
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    from bluelog.models import Admin
-    user = Admin.query.get(int(user_id))
+    from bluelog.caches import load_admin
+    user = load_admin(int(user_id))
     return user
 
 
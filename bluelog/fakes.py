@@ -1,9 +1,15 @@
 import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import click
 from faker import Faker
 from sqlalchemy.exc import IntegrityError
 
 from bluelog.extensions import db
 from bluelog.models import Admin, Category, Post, Comment, Link
+from bluelog.rendering import RENDER_VERSION, render_body
 
 
 fake = Faker('zh-CN')
@@ -40,10 +46,10 @@ def fake_posts(count=50):
     for _ in range(count):
         post = Post(
             title=fake.sentence(),
-            body=fake.text(2000),
             category=Category.query.get(random.randint(1, Category.query.count())),
             timestamp=fake.date_time_this_year()
         )
+        post.set_body(fake.text(2000))
         db.session.add(post)
     db.session.commit()
 
@@ -93,3 +99,113 @@ def fake_links():
     email = Link(name='邮箱', url='#')
     db.session.add_all([github, email])
     db.session.commit()
+
+
+def _batched(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _bulk_insert(model, rows, batch_size, label):
+    '''用 Core 的 executemany 分批插入，每批提交一次并输出速度'''
+    start = time.perf_counter()
+    count = 0
+    for batch in _batched(rows, batch_size):
+        db.session.execute(model.__table__.insert(), batch)
+        db.session.commit()
+        count += len(batch)
+        click.echo(f'\r{label}: {count} 行，{count / (time.perf_counter() - start):.0f} 行/秒', nl=False)
+    click.echo()
+
+
+def bulk_forge(categories=10, posts=100000, comments=2000000, batch_size=5000, seed=None):
+    '''
+    生成大量数据用于性能测试。所有 id、每篇文章的分类和评论数都预先确定，
+    分类、文章、评论按顺序流式生成并批量插入，计数字段直接写入正确的值。
+    文本从预先生成的语料池中随机组合，同一个 seed 生成的数据完全相同。
+    '''
+    rng = random.Random(seed)
+    fake.seed_instance(seed)
+    words = fake.words(50)
+    names = [fake.name() for _ in range(500)]
+    emails = [fake.email() for _ in range(500)]
+    sentences = [fake.sentence() for _ in range(2000)]
+    paragraphs = [fake.text(400) for _ in range(300)]
+    now = datetime.utcnow()
+    year = timedelta(days=365).total_seconds()
+
+    # 热门文章和热门分类占大部分评论和文章
+    category_weights = [rng.paretovariate(1.5) for _ in range(categories)]
+    post_categories = rng.choices(range(1, categories + 1), weights=category_weights, k=posts)
+    post_counts = Counter(post_categories)
+    post_weights = [rng.paretovariate(1.2) for _ in range(posts)]
+    comment_counts = Counter(rng.choices(range(1, posts + 1), weights=post_weights, k=comments))
+    post_times = sorted(now - timedelta(seconds=rng.random() * year) for _ in range(posts))
+
+    category_names = ['默认分类'] + [f'{rng.choice(words)}{i}' for i in range(1, categories)]
+    _bulk_insert(Category, ({
+        'id': i + 1, 'name': name, 'post_count': post_counts[i + 1]
+    } for i, name in enumerate(category_names)), batch_size, '分类')
+
+    def generate_posts():
+        for post_id in range(1, posts + 1):
+            body = '\n'.join(rng.sample(paragraphs, rng.randint(3, 12)))
+            excerpt, word_count = Post.make_excerpt(body)
+            yield {
+                'id': post_id,
+                'title': rng.choice(sentences)[:60],
+                'body': body,
+                'excerpt': excerpt,
+                'word_count': word_count,
+                'body_html': render_body(body),
+                'render_version': RENDER_VERSION,
+                'timestamp': post_times[post_id - 1],
+                'can_comment': True,
+                'category_id': post_categories[post_id - 1],
+                'comment_count': comment_counts[post_id],
+            }
+
+    def generate_comments():
+        comment_id = 0
+        for post_id in range(1, posts + 1):
+            count = comment_counts[post_id]
+            if not count:
+                continue
+            post_time = post_times[post_id - 1]
+            span = (now - post_time).total_seconds()
+            first_id = comment_id + 1
+            paths = {}
+            for offset in sorted(rng.random() * span for _ in range(count)):
+                comment_id += 1
+                kind = rng.random()
+                from_admin = kind >= 0.9
+                # 约两成评论回复本文中更早的评论，形成回复链
+                replied_id = rng.randrange(first_id, comment_id) \
+                    if comment_id > first_id and rng.random() < 0.2 else None
+                if replied_id is None:
+                    thread_id, path = comment_id, Comment.make_path(comment_id)
+                else:
+                    thread_id, path = paths[replied_id][0], Comment.make_path(comment_id, paths[replied_id][1])
+                paths[comment_id] = (thread_id, path)
+                yield {
+                    'id': comment_id,
+                    'author': 'admin' if from_admin else rng.choice(names),
+                    'email': '' if from_admin else rng.choice(emails),
+                    'body': rng.choice(sentences),
+                    'from_admin': from_admin,
+                    'read': not 0.8 <= kind < 0.9,
+                    'timestamp': post_time + timedelta(seconds=offset),
+                    'post_id': post_id,
+                    'replied_id': replied_id,
+                    'thread_id': thread_id,
+                    'path': path,
+                }
+
+    _bulk_insert(Post, generate_posts(), batch_size, '文章')
+    _bulk_insert(Comment, generate_comments(), batch_size, '评论')
@@ -0,0 +1,135 @@
+import hashlib
+import os
+from datetime import datetime
+from xml.sax.saxutils import escape, quoteattr
+
+from flask import current_app, request, url_for
+
+from bluelog.caches import site_cache, read_stamp, bump_stamp, stamp_mtime
+from bluelog.database import use_primary
+from bluelog.extensions import db
+from bluelog.models import Post
+
+
+SITEMAP_NAMESPACE = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+
+def expire_feeds():
+    '''文章新建、修改、删除或移动分类后调用，所有订阅源和网站地图在下一次请求时重新生成'''
+    bump_stamp('feeds')
+
+
+def _version():
+    # 博客标题、分类名等变化时 site_cache 的版本号也会变化
+    if not read_stamp('feeds'):
+        bump_stamp('feeds')
+    return site_cache.version() + read_stamp('feeds')
+
+
+def _last_modified():
+    return datetime.utcfromtimestamp(int(max(stamp_mtime('feeds') or 0, stamp_mtime('version') or 0)))
+
+
+def site_url(endpoint, **values):
+    '''
+    订阅源和网站地图中的完整地址。生成的文件缓存后发给所有访客，地址只按 BLOG_BASE_URL 生成，
+    不使用请求的 Host 和查询参数，否则第一个请求可以把任意域名写进缓存。
+    '''
+    return current_app.config['BLOG_BASE_URL'].rstrip('/') + url_for(endpoint, **values)
+
+
+def _isoformat(dt):
+    return dt.replace(microsecond=0).isoformat() + 'Z'
+
+
+def atom_feed(title, subtitle, link, feed_url, posts):
+    '''逐段生成 Atom 文档，feed_url 为订阅源自己的地址，posts 按时间倒序'''
+    yield '<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n'
+    yield f'<title>{escape(title)}</title>\n'
+    if subtitle:
+        yield f'<subtitle>{escape(subtitle)}</subtitle>\n'
+    yield f'<id>{escape(feed_url)}</id>\n'
+    yield f'<link href={quoteattr(link)}/>\n<link rel="self" href={quoteattr(feed_url)}/>\n'
+    updated = None
+    for post in posts:
+        if updated is None:
+            updated = post.timestamp
+            yield f'<updated>{_isoformat(updated)}</updated>\n'
+        url = site_url('blog.show_post', post_id=post.id)
+        yield (f'<entry>\n<title>{escape(post.title or "")}</title>\n<id>{escape(url)}</id>\n'
+               f'<link href={quoteattr(url)}/>\n<updated>{_isoformat(post.timestamp)}</updated>\n'
+               f'<category term={quoteattr(post.category.name)}/>\n'
+               f'<summary>{escape(post.excerpt or "")}</summary>\n'
+               f'<content type="html">{escape(post.body_html or "")}</content>\n</entry>\n')
+    if updated is None:
+        yield '<updated>1970-01-01T00:00:00Z</updated>\n'
+    yield '</feed>\n'
+
+
+def sitemap(urls):
+    '''urls 为 (地址, 最后修改时间或 None) 的迭代器'''
+    yield f'<?xml version="1.0" encoding="utf-8"?>\n<urlset xmlns="{SITEMAP_NAMESPACE}">\n'
+    for url, lastmod in urls:
+        yield f'<url><loc>{escape(url)}</loc>'
+        if lastmod is not None:
+            yield f'<lastmod>{_isoformat(lastmod)}</lastmod>'
+        yield '</url>\n'
+    yield '</urlset>\n'
+
+
+def sitemap_index(pages):
+    yield f'<?xml version="1.0" encoding="utf-8"?>\n<sitemapindex xmlns="{SITEMAP_NAMESPACE}">\n'
+    for page in range(1, pages + 1):
+        yield f'<sitemap><loc>{escape(site_url("blog.sitemap_page", page=page))}</loc></sitemap>\n'
+    yield '</sitemapindex>\n'
+
+
+def post_urls(offset, limit, batch=1000):
+    '''按 id 顺序流式读取文章地址，只查询 id 和时间'''
+    query = db.session.query(Post.id, Post.timestamp).order_by(Post.id).offset(offset).limit(limit)
+    for post_id, timestamp in query.yield_per(batch):
+        yield site_url('blog.show_post', post_id=post_id), timestamp
+
+
+def cached_xml(name, generate, mimetype='application/xml'):
+    '''
+    返回订阅源或网站地图的响应。内容写入 BLOG_CACHE_DIR/xml 下以版本号命名的文件，文章变化前一直复用。
+    ETag 和 Last-Modified 只依赖版本号文件，条件请求命中时直接返回 304，不查询数据库。
+    '''
+    version = _version()
+    # 修改 BLOG_BASE_URL 后重新生成
+    etag = hashlib.md5(f'{name}:{version}:{current_app.config["BLOG_BASE_URL"]}'.encode()).hexdigest()
+    last_modified = _last_modified()
+    response = current_app.response_class(mimetype=mimetype)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['BLOG_FEED_MAX_AGE']
+
+    # 压缩后的 ETag 带有编码名后缀，见 bluelog/compression.py
+    if any(request.if_none_match.contains(etag + suffix) for suffix in ('', '-gzip', '-br')) or (
+            not request.if_none_match and request.if_modified_since is not None
+            and request.if_modified_since >= last_modified):
+        response.status_code = 304
+        return response
+
+    # 每个订阅源一个目录，只保留当前版本
+    directory = os.path.join(current_app.config['BLOG_CACHE_DIR'], 'xml', name)
+    path = os.path.join(directory, f'{etag}.xml')
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        # 文件一直用到下一次版本更新，不能从可能落后的只读副本生成
+        with use_primary(), open(tmp_path, 'w', encoding='utf-8') as f:
+            for chunk in generate():
+                f.write(chunk)
+        os.replace(tmp_path, path)
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.xml') and entry.path != path:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+    with open(path, 'rb') as f:
+        response.set_data(f.read())
+    return response
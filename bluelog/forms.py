@@ -44,6 +44,16 @@ class CategoryForm(FlaskForm):
             raise ValidationError('该分类已存在！')
 
 
+class MergeCategoryForm(FlaskForm):
+    target = SelectField('合并到', coerce=int)
+    submit = SubmitField('合并')
+
+    def __init__(self, category, *args, **kwargs):
+        super(MergeCategoryForm, self).__init__(*args, **kwargs)
+        self.target.choices = [(c.id, c.name) for c in Category.query.order_by(Category.name).all()
+                               if c.id != category.id]
+
+
 class CommentForm(FlaskForm):
     author = StringField('姓名', validators=[DataRequired(), Length(1, 30)])
     email = StringField('邮箱', validators=[DataRequired(), Email(), Length(1, 254)])
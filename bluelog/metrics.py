@@ -0,0 +1,378 @@
+import atexit
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from flask import abort, before_render_template, current_app, g, has_request_context, request, template_rendered
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from bluelog.caches import page_cache
+from bluelog.compression import compressor
+
+
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# 已经退出的 worker 的计数合并到这个文件中
+AGGREGATE_FILE = 'aggregate.json'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_metrics_start', None)
+    if start is None or not has_request_context():
+        return
+    timing = g.get('request_timing')
+    if timing is not None:
+        timing['sql_count'] += 1
+        timing['sql'] += time.perf_counter() - start
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_label(value)}"' for name, value in labels.items()) + '}'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Metrics:
+    '''
+    统计每个端点的请求数、状态码、延迟分布、SQL 语句数和耗时、模板渲染耗时。
+    每个 worker 在内存中累加，由后台线程每隔 BLOG_METRICS_FLUSH_INTERVAL 秒写入 BLOG_CACHE_DIR/metrics/<pid>-<随机串>.json，
+    进程退出时再写入一次；/metrics 汇总目录中所有 worker 的文件，按 Prometheus 文本格式输出。
+    文件名带随机串，进程号被新 worker 重用时不会覆盖旧文件。汇总时把已经退出的 worker 的文件合并到 aggregate.json，
+    计数器不会因为 worker 重启而回落；缓存大小等瞬时值只统计仍在运行的 worker。
+    '''
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.directory = None
+        self.buckets = ()
+        self.flush_interval = 0
+        self.logger = None
+        self._lock = threading.Lock()
+        self._pid = None
+        self._name = None
+        self._dirty = False
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def _reset(self):
+        self.requests = {}   # (端点, 方法, 状态码) -> 次数
+        self.latency = {}    # 端点 -> [各区间的次数..., 超出最大区间的次数, 总秒数]
+        self.sql = {}        # 端点 -> [语句数, 总秒数]
+        self.render = {}     # 端点 -> [渲染次数, 总秒数]
+
+    def init_app(self, app):
+        if not app.config['BLOG_METRICS']:
+            return
+        self.enabled = True
+        self.directory = os.path.join(app.config['BLOG_CACHE_DIR'], 'metrics')
+        self.buckets = tuple(app.config['BLOG_METRICS_BUCKETS'])
+        self.flush_interval = app.config['BLOG_METRICS_FLUSH_INTERVAL']
+        self.logger = app.logger
+        os.makedirs(self.directory, exist_ok=True)
+
+        # 先注册的 before_request 最先执行，after_request 最后执行，计时包含其他钩子和压缩
+        app.before_request_funcs.setdefault(None, []).insert(0, self.start_request)
+        app.after_request_funcs.setdefault(None, []).insert(0, self.finish_request)
+        before_render_template.connect(self.start_render, app)
+        template_rendered.connect(self.finish_render, app)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+        # 监听所有引擎，包括只读副本；多次 init_app 也只注册一次
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    def _start_process(self):
+        # 每个进程（包括预加载应用后 fork 出的 worker）第一次处理请求时启动写入线程
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._name = f'{self._pid}-{secrets.token_hex(4)}'
+        threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+        atexit.register(self.flush)
+
+    def _flush_loop(self):
+        # 空闲的 worker 也会写入最后一个请求之后的计数
+        while True:
+            time.sleep(self.flush_interval or 1)
+            if self._dirty:
+                self.flush()
+
+    def start_request(self):
+        if self.enabled:
+            if self._pid != os.getpid():
+                self._start_process()
+            g.request_timing = {'start': time.perf_counter(), 'sql_count': 0, 'sql': 0.0, 'render': 0.0,
+                                'rendering': []}
+
+    def start_render(self, app, template, context):
+        timing = g.get('request_timing')
+        if timing is not None:
+            timing['rendering'].append(time.perf_counter())
+
+    def finish_render(self, app, template, context):
+        timing = g.get('request_timing')
+        if timing is not None and timing['rendering']:
+            start = timing['rendering'].pop()
+            # 模板中嵌套调用 render_template 时只计最外层
+            if not timing['rendering']:
+                timing['render'] += time.perf_counter() - start
+
+    def finish_request(self, response):
+        timing = g.pop('request_timing', None)
+        if timing is None:
+            return response
+        total = time.perf_counter() - timing['start']
+        endpoint = request.endpoint or 'none'
+        key = (endpoint, request.method, response.status_code)
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            latency = self.latency.setdefault(endpoint, [0] * (len(self.buckets) + 2))
+            latency[next((i for i, bound in enumerate(self.buckets) if total <= bound), len(self.buckets))] += 1
+            latency[-1] += total
+            sql = self.sql.setdefault(endpoint, [0, 0.0])
+            sql[0] += timing['sql_count']
+            sql[1] += timing['sql']
+            if timing['render']:
+                render = self.render.setdefault(endpoint, [0, 0.0])
+                render[0] += 1
+                render[1] += timing['render']
+            self._dirty = True
+
+        if current_app.config['BLOG_SERVER_TIMING']:
+            response.headers['Server-Timing'] = (
+                f'db;dur={timing["sql"] * 1000:.1f};desc="{timing["sql_count"]} queries", '
+                f'render;dur={timing["render"] * 1000:.1f}, total;dur={total * 1000:.1f}')
+        return response
+
+    def snapshot(self):
+        '''当前进程的统计，可以写入 JSON'''
+        with self._lock:
+            return {
+                'name': self._name,
+                'pid': os.getpid(),
+                'time': time.time(),
+                'buckets': list(self.buckets),
+                'requests': [[*key, count] for key, count in self.requests.items()],
+                'latency': {endpoint: list(values) for endpoint, values in self.latency.items()},
+                'sql': {endpoint: list(values) for endpoint, values in self.sql.items()},
+                'render': {endpoint: list(values) for endpoint, values in self.render.items()},
+                'page_cache': {'hits': page_cache.hits, 'misses': page_cache.misses},
+                'compress_cache': compressor.stats(),
+            }
+
+    def flush(self):
+        if self._name is None:
+            return
+        self._dirty = False
+        path = os.path.join(self.directory, f'{self._name}.json')
+        tmp_path = f'{path}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self._dirty = True
+            self.logger.warning('Failed to write metrics: %s', e)
+
+    def _read(self):
+        # 返回 {文件路径: 统计}，读取失败的文件跳过
+        snapshots = {}
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                with open(entry.path) as f:
+                    snapshots[entry.path] = json.load(f)
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def _fold(self, paths):
+        '''把已经退出的 worker 的文件加到 aggregate.json 中再删除，没有 fcntl 的平台上不合并'''
+        if fcntl is None:
+            return
+        aggregate_path = os.path.join(self.directory, AGGREGATE_FILE)
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # 持有锁之后重新读取，其他进程可能刚刚合并过同一批文件
+            snapshots = self._read()
+            aggregate = snapshots.pop(aggregate_path, None)
+            dead = [path for path in paths if path in snapshots]
+            if not dead:
+                return
+            aggregate = merge([aggregate] + [snapshots[path] for path in dead], self.buckets)
+            tmp_path = f'{aggregate_path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(aggregate, f)
+            os.replace(tmp_path, aggregate_path)
+            for path in dead:
+                os.remove(path)
+
+    def collect(self, include_self=True):
+        '''
+        读取所有 worker 的统计，当前进程使用内存中的最新数据；命令行中不处理请求，include_self 为 False。
+        进程已经不存在，或者同一个进程号有更新的文件（进程号被重用）的 worker 视为已经退出，
+        它们的文件合并到 aggregate.json。返回的每份统计带有 live 字段
+        '''
+        snapshots = self._read()
+        aggregate_path = os.path.join(self.directory, AGGREGATE_FILE)
+        aggregate = snapshots.pop(aggregate_path, None)
+        if include_self and self._name is not None:
+            snapshots[os.path.join(self.directory, f'{self._name}.json')] = self.snapshot()
+        newest = {}
+        for path, snapshot in snapshots.items():
+            pid = snapshot['pid']
+            # 升级前写入的文件没有 time，按最旧处理
+            if pid not in newest or snapshot.get('time', 0) > snapshots[newest[pid]].get('time', 0):
+                newest[pid] = path
+        dead = [path for path, snapshot in snapshots.items()
+                if newest[snapshot['pid']] != path or not _pid_alive(snapshot['pid'])]
+        if dead:
+            try:
+                self._fold(dead)
+            except OSError as e:
+                self.logger.warning('Failed to merge metrics: %s', e)
+        result = [aggregate] if aggregate is not None else []
+        for path, snapshot in snapshots.items():
+            snapshot['live'] = path not in dead
+            result.append(snapshot)
+        if include_self and self._name is None:
+            result.append(dict(self.snapshot(), live=True))
+        return result
+
+    def clear(self):
+        '''清空所有 worker 的统计，已经在运行的其他 worker 下次写入时会恢复各自的数据'''
+        with self._lock:
+            self._reset()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def metrics_view(self):
+        '''设置了 BLOG_METRICS_TOKEN 时用 Authorization: Bearer <令牌> 访问，登录的管理员也可以直接查看'''
+        token = current_app.config['BLOG_METRICS_TOKEN']
+        authorization = request.headers.get('Authorization', '')
+        authorized = token and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
+        if not authorized and not current_user.is_authenticated:
+            abort(404)
+        response = current_app.response_class(''.join(exposition(self.collect(), self.buckets)), mimetype='text/plain')
+        response.headers['Content-Type'] = PROMETHEUS_MIMETYPE
+        response.cache_control.no_store = True
+        return response
+
+
+def merge(snapshots, buckets):
+    '''把多份统计的计数器相加，得到一份不属于任何进程的统计；延迟区间和 buckets 不同的延迟分布丢弃'''
+    requests, latency, sql, render = {}, {}, {}, {}
+    page_cache_totals = {'hits': 0, 'misses': 0}
+    for snapshot in snapshots:
+        if snapshot is None:
+            continue
+        for endpoint, method, status, count in snapshot['requests']:
+            requests[endpoint, method, status] = requests.get((endpoint, method, status), 0) + count
+        # 修改 BLOG_METRICS_BUCKETS 之前写入的延迟分布无法合并，跳过
+        if tuple(snapshot['buckets']) == buckets:
+            for endpoint, values in snapshot['latency'].items():
+                total = latency.get(endpoint, [0] * len(values))
+                latency[endpoint] = [a + b for a, b in zip(total, values)]
+        for totals, name in ((sql, 'sql'), (render, 'render')):
+            for endpoint, (count, seconds) in snapshot[name].items():
+                count_total, seconds_total = totals.get(endpoint, (0, 0.0))
+                totals[endpoint] = [count_total + count, seconds_total + seconds]
+        for name in page_cache_totals:
+            page_cache_totals[name] += snapshot['page_cache'][name]
+    return {
+        'name': 'aggregate',
+        'pid': None,
+        'time': time.time(),
+        'buckets': list(buckets),
+        'requests': [[*key, count] for key, count in requests.items()],
+        'latency': latency,
+        'sql': sql,
+        'render': render,
+        'page_cache': page_cache_totals,
+        'compress_cache': {},
+    }
+
+
+def exposition(snapshots, buckets):
+    '''汇总各 worker 的统计，逐行生成 Prometheus 文本格式，buckets 为当前配置的延迟区间'''
+    totals = merge(snapshots, buckets)
+    requests = {(endpoint, method, status): count for endpoint, method, status, count in totals['requests']}
+    latency, sql, render, page_cache_totals = totals['latency'], totals['sql'], totals['render'], totals['page_cache']
+    compress_totals = {'entries': 0, 'size': 0}
+    live = 0
+    for snapshot in snapshots:
+        if snapshot.get('live'):
+            live += 1
+            for name in compress_totals:
+                compress_totals[name] += snapshot['compress_cache'].get(name, 0)
+
+    yield '# HELP bluelog_http_requests_total Requests by endpoint, method and status.\n'
+    yield '# TYPE bluelog_http_requests_total counter\n'
+    for (endpoint, method, status), count in sorted(requests.items()):
+        yield f'bluelog_http_requests_total{_labels(endpoint=endpoint, method=method, status=status)} {count}\n'
+
+    yield '# HELP bluelog_http_request_duration_seconds Request latency by endpoint.\n'
+    yield '# TYPE bluelog_http_request_duration_seconds histogram\n'
+    for endpoint, values in sorted(latency.items()):
+        cumulative = 0
+        for bound, count in zip(buckets + ('+Inf',), values):
+            cumulative += count
+            yield f'bluelog_http_request_duration_seconds_bucket{_labels(endpoint=endpoint, le=bound)} {cumulative}\n'
+        yield f'bluelog_http_request_duration_seconds_sum{_labels(endpoint=endpoint)} {values[-1]}\n'
+        yield f'bluelog_http_request_duration_seconds_count{_labels(endpoint=endpoint)} {cumulative}\n'
+
+    for name, help_text, totals, index in (
+            ('bluelog_sql_queries_total', 'SQL statements executed by endpoint.', sql, 0),
+            ('bluelog_sql_duration_seconds_total', 'Time spent in SQL statements by endpoint.', sql, 1),
+            ('bluelog_template_renders_total', 'Template renders by endpoint.', render, 0),
+            ('bluelog_template_render_seconds_total', 'Time spent rendering templates by endpoint.', render, 1)):
+        yield f'# HELP {name} {help_text}\n# TYPE {name} counter\n'
+        for endpoint, values in sorted(totals.items()):
+            yield f'{name}{_labels(endpoint=endpoint)} {values[index]}\n'
+
+    yield '# HELP bluelog_page_cache_requests_total Page cache lookups by result.\n'
+    yield '# TYPE bluelog_page_cache_requests_total counter\n'
+    for result, count in page_cache_totals.items():
+        yield f'bluelog_page_cache_requests_total{_labels(result=result)} {count}\n'
+    yield '# HELP bluelog_compress_cache_entries Compressed responses cached in worker memory.\n'
+    yield f'# TYPE bluelog_compress_cache_entries gauge\nbluelog_compress_cache_entries {compress_totals["entries"]}\n'
+    yield '# HELP bluelog_compress_cache_bytes Size of compressed responses cached in worker memory.\n'
+    yield f'# TYPE bluelog_compress_cache_bytes gauge\nbluelog_compress_cache_bytes {compress_totals["size"]}\n'
+    yield '# HELP bluelog_workers Running processes that have reported metrics.\n'
+    yield f'# TYPE bluelog_workers gauge\nbluelog_workers {live}\n'
+
+
+metrics = Metrics()
@@ -1,8 +1,12 @@
+from collections import Counter
 from datetime import datetime
 from flask_login import UserMixin
+from markupsafe import Markup
+from sqlalchemy import func, select
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from bluelog.extensions import db
+from bluelog.rendering import RENDER_VERSION, render_body
 
 
 class Admin(db.Model, UserMixin):
@@ -26,16 +30,35 @@ class Admin(db.Model, UserMixin):
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30), unique=True)
+    # 冗余计数，避免渲染时加载整个 posts 集合
+    post_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
 
     posts = db.relationship('Post', back_populates='category')
 
-    def delete(self):
-        default_category = Category.query.get(1)
-        posts = self.posts[:]
-        for post in posts:
-            post.category = default_category
-        db.session.delete(self)
+    def delete(self, target=None):
+        '''删除分类，文章移到 target 中，默认移到默认分类，返回移动的篇数'''
+        moved = self.merge_into(target or Category.query.get(1))
+        # 按主键删除，db.session.delete() 会先加载 posts 集合来解除关联
+        Category.query.filter_by(id=self.id).delete()
         db.session.commit()
+        return moved
+
+    def merge_into(self, category):
+        '''
+        把本分类的文章全部移到 category 中，只执行一条 UPDATE，不加载文章，返回移动的篇数。
+        调用方负责提交。
+        '''
+        moved = Post.query.filter_by(category_id=self.id) \
+            .update({Post.category_id: category.id}, synchronize_session=False)
+        category.post_count = Category.post_count + moved
+        self.post_count = 0
+        return moved
+
+    @staticmethod
+    def recount():
+        '''按文章表重新统计所有分类的文章数'''
+        count = select([func.count(Post.id)]).where(Post.category_id == Category.id).as_scalar()
+        Category.query.update({Category.post_count: count}, synchronize_session=False)
 
 
 # 文章
@@ -43,14 +66,114 @@ class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(60))
     body = db.Column(db.Text)
+    # 正文的纯文本摘要和字数，在保存正文时计算，列表页不需要读取正文
+    excerpt = db.Column(db.Text)
+    word_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # 过滤和处理后的正文 HTML，文章页直接输出；render_version 为渲染时 bluelog/rendering.py 的版本号。
+    # 延迟加载，列表页不读取，文章页和订阅源用 db.undefer(Post.body_html) 一起取出
+    body_html = db.deferred(db.Column(db.Text))
+    render_version = db.Column(db.Integer)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     can_comment = db.Column(db.Boolean, default=True)
+    # 冗余计数，包含回复在内的评论总数
+    comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
 
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
     category = db.relationship('Category', back_populates='posts')
 
     comments = db.relationship('Comment', back_populates='post', cascade='all, delete-orphan')
 
+    # 分类页按 (timestamp, id) 倒序分页。SQLite 和 InnoDB 的二级索引都隐含主键，
+    # 索引中不需要再加 id 就能按 (timestamp, id) 排序
+    __table_args__ = (
+        db.Index('ix_post_category_id_timestamp', 'category_id', 'timestamp'),
+    )
+
+    EXCERPT_LENGTH = 255
+
+    def set_body(self, body):
+        self.body = body
+        self.excerpt, self.word_count = self.make_excerpt(body)
+        self.body_html = render_body(body)
+        self.render_version = RENDER_VERSION
+
+    @classmethod
+    def make_excerpt(cls, body):
+        '''返回 (摘要, 字数)，和模板中 body|striptags|truncate 的结果一致'''
+        text = Markup(body or '').striptags()
+        if len(text) <= cls.EXCERPT_LENGTH + 5:
+            return text, len(text)
+        excerpt = text[:cls.EXCERPT_LENGTH - 3].rsplit(' ', 1)[0]
+        return excerpt + '...', len(text)
+
+    @staticmethod
+    def update_excerpts(update_all=False, batch=500, progress=None):
+        '''
+        按 id 分批根据正文生成摘要和字数，每批提交一次，返回处理的文章数。
+        默认只处理没有摘要的文章；progress 为每批之后调用的函数，参数为已处理的篇数
+        '''
+        query = db.session.query(Post.id, Post.body).order_by(Post.id)
+        if not update_all:
+            query = query.filter(Post.excerpt.is_(None))
+        last_id = 0
+        total = 0
+        while True:
+            rows = query.filter(Post.id > last_id).limit(batch).all()
+            if not rows:
+                return total
+            mappings = []
+            for id_, body in rows:
+                excerpt, word_count = Post.make_excerpt(body)
+                mappings.append({'id': id_, 'excerpt': excerpt, 'word_count': word_count})
+            db.session.bulk_update_mappings(Post, mappings)
+            db.session.commit()
+            last_id = rows[-1].id
+            total += len(rows)
+            if progress is not None:
+                progress(total)
+
+    @staticmethod
+    def recount():
+        '''按评论表重新统计所有文章的评论数'''
+        count = select([func.count(Comment.id)]).where(Comment.post_id == Post.id).as_scalar()
+        Post.query.update({Post.comment_count: count}, synchronize_session=False)
+
+    @staticmethod
+    def _uncount(post_ids):
+        # 从各分类的文章数中减去这些文章，返回 {分类 id: 篇数}
+        counts = dict(db.session.query(Post.category_id, func.count(Post.id))
+                      .filter(Post.id.in_(post_ids)).group_by(Post.category_id))
+        for category_id, count in counts.items():
+            Category.query.filter_by(id=category_id) \
+                .update({Category.post_count: Category.post_count - count}, synchronize_session=False)
+        return counts
+
+    @staticmethod
+    def delete_many(post_ids):
+        '''
+        删除一批文章及其全部评论，返回 (文章数, 评论数)。
+        先清空 replied_id 再删除评论，一条 DELETE 里的父子评论不会触发外键约束。调用方负责提交。
+        '''
+        Post._uncount(post_ids)
+        comments = Comment.query.filter(Comment.post_id.in_(post_ids))
+        comments.update({Comment.replied_id: None}, synchronize_session=False)
+        comment_count = comments.delete(synchronize_session=False)
+        post_count = Post.query.filter(Post.id.in_(post_ids)).delete(synchronize_session=False)
+        return post_count, comment_count
+
+    @staticmethod
+    def move_many(post_ids, category):
+        '''把一批文章移到 category 中，返回实际移动的篇数。调用方负责提交'''
+        post_ids = [post_id for post_id, in db.session.query(Post.id)
+                    .filter(Post.id.in_(post_ids), Post.category_id != category.id)]
+        if not post_ids:
+            return 0
+        Post._uncount(post_ids)
+        moved = Post.query.filter(Post.id.in_(post_ids)) \
+            .update({Post.category_id: category.id}, synchronize_session=False)
+        category.post_count = Category.post_count + moved
+        return moved
+
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -69,6 +192,176 @@ class Comment(db.Model):
     replies = db.relationship('Comment', back_populates='replied', cascade='all, delete-orphan')
     replied = db.relationship('Comment', back_populates='replies', remote_side=[id])
 
+    # 物化路径：从顶层评论到本评论每一层 id 的定长十六进制拼接，按 path 排序就是回复树的先序遍历。
+    # thread_id 为所在顶层评论的 id，一次查询即可取出若干个顶层评论下的全部回复
+    thread_id = db.Column(db.Integer, index=True)
+    path = db.Column(db.String(256))
+
+    # 文章页按时间分页取出顶层评论 (post_id = ? AND replied_id IS NULL)；后台评论管理和未读数按 read 过滤
+    __table_args__ = (
+        db.Index('ix_comment_post_id_replied_id_timestamp', 'post_id', 'replied_id', 'timestamp'),
+        db.Index('ix_comment_read_timestamp', 'read', 'timestamp'),
+    )
+
+    PATH_WIDTH = 8
+    MAX_DEPTH = 32
+
+    @staticmethod
+    def make_path(comment_id, parent_path=None):
+        '''超过 MAX_DEPTH 层的回复挂在父评论的同一层，路径长度不会超出列宽'''
+        segment = f'{comment_id:0{Comment.PATH_WIDTH}x}'
+        if parent_path is None:
+            return segment
+        if len(parent_path) >= Comment.PATH_WIDTH * Comment.MAX_DEPTH:
+            parent_path = parent_path[:-Comment.PATH_WIDTH]
+        return parent_path + segment
+
+    def set_path(self):
+        '''新评论 flush 得到 id 后调用'''
+        if self.replied is None:
+            self.thread_id = self.id
+            self.path = Comment.make_path(self.id)
+        else:
+            self.thread_id = self.replied.thread_id
+            self.path = Comment.make_path(self.id, self.replied.path)
+
+    @property
+    def depth(self):
+        return len(self.path) // Comment.PATH_WIDTH - 1 if self.path else 0
+
+    @staticmethod
+    def load_threads(roots):
+        '''
+        取出一页顶层评论下的全部回复，只执行一次查询，返回按显示顺序排列的评论列表：
+        每个顶层评论后面紧跟它的回复，回复按回复树的先序排列，depth 为缩进层数。
+        '''
+        if not roots:
+            return []
+        replies = {}
+        for reply in Comment.query.filter(Comment.thread_id.in_([root.id for root in roots]),
+                                          Comment.replied_id.isnot(None)).order_by(Comment.path):
+            replies.setdefault(reply.thread_id, []).append(reply)
+        comments = []
+        for root in roots:
+            comments.append(root)
+            comments.extend(replies.get(root.id, []))
+        return comments
+
+    @staticmethod
+    def rebuild_paths(batch=5000):
+        '''按文章逐个重建所有评论的 thread_id 和 path，返回处理的评论数'''
+        total = 0
+        mappings = []
+        current_post = None
+        paths = {}
+        rows = db.session.query(Comment.id, Comment.replied_id, Comment.post_id) \
+            .order_by(Comment.post_id, Comment.id).yield_per(batch)
+        for comment_id, replied_id, post_id in rows:
+            if post_id != current_post:
+                current_post = post_id
+                paths = {}
+            parent = paths.get(replied_id)
+            if parent is None:
+                thread_id, path = comment_id, Comment.make_path(comment_id)
+            else:
+                thread_id, path = parent[0], Comment.make_path(comment_id, parent[1])
+            paths[comment_id] = (thread_id, path)
+            mappings.append({'id': comment_id, 'thread_id': thread_id, 'path': path})
+            if len(mappings) >= batch:
+                total += Comment._update_paths(mappings)
+                mappings = []
+        total += Comment._update_paths(mappings)
+        db.session.commit()
+        return total
+
+    @staticmethod
+    def _update_paths(mappings):
+        # 不能在 yield_per 的游标还没读完时提交，这里只执行 UPDATE
+        if mappings:
+            db.session.bulk_update_mappings(Comment, mappings)
+        return len(mappings)
+
+    # 单条语句中 IN 列表的最大长度，SQLite 默认最多 999 个参数
+    IN_BATCH = 500
+
+    @staticmethod
+    def thread_ids(ids):
+        '''
+        给定评论及其所有回复的 id，按层返回 [[第一层], [第二层], ...]。
+        每一层只执行一次按 replied_id 的查询，不加载评论对象。
+        '''
+        levels = []
+        seen = set()
+        level = list(set(ids))
+        while level:
+            levels.append(level)
+            seen.update(level)
+            children = []
+            for start in range(0, len(level), Comment.IN_BATCH):
+                chunk = level[start:start + Comment.IN_BATCH]
+                children.extend(row[0] for row in db.session.query(Comment.id).filter(Comment.replied_id.in_(chunk)))
+            level = [comment_id for comment_id in set(children) if comment_id not in seen]
+        return levels
+
+    @staticmethod
+    def delete_threads(ids):
+        '''
+        删除给定评论及其所有回复，同时扣减所属文章的评论数，返回 (删除条数, 受影响的文章 id)。
+        使用集合式的 UPDATE / DELETE，从最深的一层开始删，外键约束不会被先删的父评论挡住。
+        调用方负责提交。
+        '''
+        levels = Comment.thread_ids(ids)
+        all_ids = [comment_id for level in levels for comment_id in level]
+        if not all_ids:
+            return 0, []
+
+        removed = Counter()
+        for start in range(0, len(all_ids), Comment.IN_BATCH):
+            chunk = all_ids[start:start + Comment.IN_BATCH]
+            removed.update(dict(db.session.query(Comment.post_id, func.count(Comment.id))
+                                .filter(Comment.id.in_(chunk)).group_by(Comment.post_id)))
+        for post_id, count in removed.items():
+            if post_id is not None:
+                Post.query.filter_by(id=post_id).update({Post.comment_count: Post.comment_count - count},
+                                                        synchronize_session=False)
+
+        deleted = 0
+        for level in reversed(levels):
+            for start in range(0, len(level), Comment.IN_BATCH):
+                chunk = level[start:start + Comment.IN_BATCH]
+                deleted += Comment.query.filter(Comment.id.in_(chunk)).delete(synchronize_session=False)
+        return deleted, [post_id for post_id in removed if post_id is not None]
+
+
+# 全文搜索的倒排索引，只在没有 SQLite FTS5 时使用，见 bluelog/search.py
+class SearchTerm(db.Model):
+    term = db.Column(db.String(64), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), primary_key=True, index=True)
+    frequency = db.Column(db.Integer, nullable=False)
+
+
+class SearchDocument(db.Model):
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), primary_key=True)
+    length = db.Column(db.Integer, nullable=False)
+
+
+# 发件箱，邮件先写入这里，再由 bluelog/emails.py 中的 worker 批量发送
+class Outbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(254))
+    subject = db.Column(db.String(100))
+    html = db.Column(db.Text)
+    # 相同 key 的通知在时间窗口内合并为一封
+    key = db.Column(db.String(100), index=True)
+    status = db.Column(db.String(10), default='pending', index=True)    # 'pending', 'sent', 'failed'
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    send_after = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    sent_at = db.Column(db.DateTime)
+    lock_token = db.Column(db.String(32), index=True)
+    locked_until = db.Column(db.DateTime)
+
 
 class Link(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -0,0 +1,89 @@
+from datetime import datetime
+
+from flask import request, current_app, url_for, abort
+from flask_sqlalchemy import Pagination
+from sqlalchemy import or_, and_
+
+
+def encode_cursor(item):
+    return f'{item.timestamp.isoformat()}_{item.id}'
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, id_ = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(timestamp), int(id_)
+    except ValueError:
+        abort(400)
+
+
+class KeysetPagination:
+    '''
+    按 (timestamp, id) 倒序的游标分页，before 参数取更早的一页，after 参数取更新的一页。
+    不做 OFFSET 扫描也不做 COUNT(*)，total 由调用方从计数字段等处提供，可以为 None。
+    '''
+
+    keyset = True
+    page = None
+
+    def __init__(self, items, per_page, has_prev, has_next, total=None):
+        self.items = items
+        self.per_page = per_page
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.total = total
+
+    def _url(self, **cursor):
+        args = {key: value for key, value in request.args.items() if key not in ('page', 'before', 'after')}
+        args.update(request.view_args)
+        return url_for(request.endpoint, **args, **cursor)
+
+    @property
+    def prev_url(self):
+        # 较新的一页
+        return self._url(after=encode_cursor(self.items[0])) if self.has_prev and self.items else None
+
+    @property
+    def next_url(self):
+        # 较早的一页
+        return self._url(before=encode_cursor(self.items[-1])) if self.has_next and self.items else None
+
+
+def paginate(query, model, per_page, total=None):
+    '''
+    按时间倒序分页。BLOG_PAGINATION 为 'keyset' 且请求中没有 page 参数时使用游标分页，
+    否则按页码分页，旧的 ?page= 链接仍然有效。
+
+    total 可以是数字或返回数字的函数，给出时页码分页也不再执行 COUNT(*)。
+    '''
+    order = (model.timestamp.desc(), model.id.desc())
+    page = request.args.get('page', type=int)
+    if current_app.config['BLOG_PAGINATION'] != 'keyset' or page is not None:
+        page = page or 1
+        if total is None:
+            return query.order_by(*order).paginate(page, per_page)
+        items = query.order_by(*order).limit(per_page).offset((page - 1) * per_page).all()
+        if page > 1 and not items:
+            abort(404)
+        return Pagination(query, page, per_page, total() if callable(total) else total, items)
+
+    before = request.args.get('before')
+    after = request.args.get('after')
+    if after:
+        timestamp, id_ = decode_cursor(after)
+        query = query.filter(or_(model.timestamp > timestamp,
+                                 and_(model.timestamp == timestamp, model.id > id_)))
+        items = query.order_by(model.timestamp, model.id).limit(per_page + 1).all()
+        has_prev = len(items) > per_page
+        items = items[:per_page][::-1]
+        has_next = True
+    else:
+        if before:
+            timestamp, id_ = decode_cursor(before)
+            query = query.filter(or_(model.timestamp < timestamp,
+                                     and_(model.timestamp == timestamp, model.id < id_)))
+        items = query.order_by(*order).limit(per_page + 1).all()
+        has_next = len(items) > per_page
+        items = items[:per_page]
+        has_prev = before is not None
+    return KeysetPagination(items, per_page, has_prev, has_next, total() if callable(total) else total)
@@ -0,0 +1,113 @@
+import re
+import time
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request, request_finished
+from flask_sqlalchemy import get_debug_queries
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+# 和 get_debug_queries() 的元素一样有 statement、parameters 和 duration 属性
+RecordedQuery = namedtuple('RecordedQuery', 'statement parameters duration')
+
+
+_literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+\b|%\(\w+\)s|:\w+")
+_in_list_re = re.compile(r'\bIN \((?:\?, )*\?\)', re.IGNORECASE)
+_space_re = re.compile(r'\s+')
+
+
+def normalize_sql(statement):
+    '''把语句中的字面量和参数都换成 ?，IN 列表合并为一个参数，得到语句的形状'''
+    statement = _literal_re.sub('?', statement)
+    statement = _space_re.sub(' ', statement).strip()
+    return _in_list_re.sub('IN (?)', statement)
+
+
+def query_budget(limit):
+    '''
+    声明视图每次请求最多执行的 SQL 语句数，超出时按 BLOG_QUERY_BUDGET_ACTION 记录日志或抛出异常。
+    需要紧跟在 route 装饰器下面，预算记录在注册为视图的函数上。
+    '''
+    def decorator(f):
+        f.query_budget = limit
+        return f
+    return decorator
+
+
+def repeated_queries(queries, threshold):
+    '''按形状分组，返回执行次数不少于 threshold 次的 [(形状, 次数)]，通常就是 N+1 查询'''
+    shapes = Counter(normalize_sql(query.statement) for query in queries)
+    return [(shape, count) for shape, count in shapes.most_common() if count >= threshold]
+
+
+def check_queries(response):
+    '''after_request 钩子：检查本次请求记录到的 SQL，报告 N+1 查询和超出预算的视图'''
+    queries = get_debug_queries()
+    if not queries:
+        return response
+
+    endpoint = request.endpoint
+    for shape, count in repeated_queries(queries, current_app.config['BLOG_QUERY_REPEAT_THRESHOLD']):
+        current_app.logger.warning('N+1 queries in %s: %d x %s', endpoint, count, shape)
+
+    view = current_app.view_functions.get(endpoint)
+    limit = getattr(view, 'query_budget', None)
+    if limit is not None and len(queries) > limit:
+        message = f'{endpoint} executed {len(queries)} queries, budget is {limit}'
+        if current_app.config['BLOG_QUERY_BUDGET_ACTION'] == 'raise':
+            raise QueryBudgetExceeded(message)
+        current_app.logger.warning(message)
+    return response
+
+
+@contextmanager
+def record_queries(app):
+    '''
+    收集期间每个请求执行的 SQL，得到 [(端点, 查询列表)]，供测试和压测使用：
+
+        with record_queries(app) as recorded:
+            client.get('/')
+
+    直接监听引擎执行的语句，不依赖 SQLALCHEMY_RECORD_QUERIES，生产配置下同样可以统计
+    '''
+    recorded = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_budget_start = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not has_request_context() or current_app._get_current_object() is not app:
+            return
+        start = getattr(context, '_query_budget_start', None)
+        duration = time.perf_counter() - start if start is not None else 0.0
+        g.setdefault('recorded_queries', []).append(RecordedQuery(statement, parameters, duration))
+
+    def on_request_finished(sender, response, **extra):
+        recorded.append((request.endpoint, g.pop('recorded_queries', [])))
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    try:
+        with request_finished.connected_to(on_request_finished, app):
+            yield recorded
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.remove(Engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def assert_query_count(client, url, expected, method='GET', **kwargs):
+    '''请求 url 并断言执行的 SQL 语句数不超过 expected，返回响应'''
+    with record_queries(client.application) as recorded:
+        response = client.open(url, method=method, **kwargs)
+    queries = [query for _, endpoint_queries in recorded for query in endpoint_queries]
+    assert len(queries) <= expected, (
+        f'{method} {url} executed {len(queries)} queries, expected at most {expected}:\n'
+        + '\n'.join(normalize_sql(query.statement) for query in queries))
+    return response
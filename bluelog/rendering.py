@@ -0,0 +1,193 @@
+import re
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import urlparse
+
+
+# 渲染流程有变化时加一，flask rerender 会重新渲染版本号较旧的文章
+RENDER_VERSION = 2
+
+ALLOWED_TAGS = {
+    'a', 'abbr', 'b', 'blockquote', 'br', 'caption', 'code', 'del', 'div', 'em', 'figcaption', 'figure',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'ins', 'kbd', 'li', 'ol', 'p', 'pre', 's', 'small',
+    'span', 'strike', 'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'u', 'ul',
+}
+ALLOWED_ATTRIBUTES = {
+    'a': {'href', 'title', 'target'},
+    'abbr': {'title'},
+    'img': {'src', 'alt', 'title', 'width', 'height'},
+    'td': {'colspan', 'rowspan'},
+    'th': {'colspan', 'rowspan'},
+    'ol': {'start'},
+    'code': {'class'},
+    'pre': {'class'},
+}
+# 所有标签都允许的 style 属性，只保留下面几项（包括编辑器设置的文字颜色、背景色和字号），
+# Word 粘贴带来的 mso-* 等样式全部去掉
+ALLOWED_STYLES = {'text-align', 'width', 'height', 'float', 'margin-left', 'margin-right',
+                  'color', 'background-color', 'font-size'}
+VOID_TAGS = {'br', 'hr', 'img'}
+# 连同内容一起丢弃的标签，xml 为 Word 粘贴时夹带的文档属性
+DROP_CONTENT_TAGS = {'script', 'style', 'iframe', 'object', 'embed', 'xml', 'noscript', 'template'}
+ALLOWED_SCHEMES = {'', 'http', 'https', 'mailto'}
+ANCHOR_TAGS = {'h2', 'h3', 'h4'}
+# 标题锚点 id 的前缀，避免和页面模板中的 id（如 comments、comment-form）冲突
+ANCHOR_PREFIX = 'h-'
+# 可以省略结束标签的元素：开始新标签时先闭合这些还开着的同类标签
+IMPLIED_END = {
+    'li': {'li'},
+    'p': {'p'},
+    'td': {'td', 'th'},
+    'th': {'td', 'th'},
+    'tr': {'tr', 'td', 'th'},
+}
+
+_class_re = re.compile(r'^(language|lang)-[\w+#-]+$')
+_style_value_re = re.compile(r'^[\w\s.%#-]+$')
+# 颜色值只额外允许 rgb() / rgba()，其他带括号的值（url()、expression() 等）都去掉
+_color_function_re = re.compile(r'^rgba?\([\d\s.,%]+\)$')
+_slug_re = re.compile(r'\W+')
+
+
+def _safe_url(url):
+    url = ''.join(ch for ch in url if ch > ' ').strip()
+    try:
+        return urlparse(url).scheme.lower() in ALLOWED_SCHEMES
+    except ValueError:
+        return False
+
+
+def _clean_style(style):
+    declarations = []
+    for declaration in style.split(';'):
+        name, _, value = declaration.partition(':')
+        name, value = name.strip().lower(), value.strip()
+        if name in ALLOWED_STYLES and (_style_value_re.match(value) or _color_function_re.match(value)):
+            declarations.append(f'{name}: {value}')
+    return '; '.join(declarations)
+
+
+def _slugify(text):
+    return _slug_re.sub('-', text.strip().lower()).strip('-')[:60]
+
+
+class Sanitizer(HTMLParser):
+    '''
+    基于标准库 HTMLParser 的白名单过滤：不在白名单中的标签去掉但保留文字，属性和链接协议逐个检查，
+    注释和 Word 的条件注释全部丢弃。同时给图片加上 loading="lazy"，给 h2-h4 加上锚点 id。
+    '''
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self.stack = []
+        # 正在丢弃内容的标签及其嵌套层数
+        self.dropping = None
+        self.drop_depth = 0
+        self.slugs = set()
+        # (标题开始标签在 out 中的位置, 标签名, 属性, 已收集的标题文字)
+        self.heading = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.dropping is not None:
+            if tag == self.dropping:
+                self.drop_depth += 1
+            return
+        if tag in DROP_CONTENT_TAGS:
+            self.dropping = tag
+            self.drop_depth = 1
+            return
+        if tag not in ALLOWED_TAGS:
+            return
+
+        allowed = ALLOWED_ATTRIBUTES.get(tag, set())
+        cleaned = []
+        for name, value in attrs:
+            value = value or ''
+            if name == 'style':
+                value = _clean_style(value)
+                if value:
+                    cleaned.append((name, value))
+            elif name in allowed:
+                if name in ('href', 'src') and not _safe_url(value):
+                    continue
+                if name == 'class' and not _class_re.match(value):
+                    continue
+                cleaned.append((name, value))
+        if tag == 'img':
+            if not any(name == 'src' for name, _ in cleaned):
+                return
+            cleaned += [('loading', 'lazy'), ('decoding', 'async')]
+        if tag == 'a' and any(name == 'target' for name, _ in cleaned):
+            cleaned.append(('rel', 'noopener noreferrer'))
+
+        implied = IMPLIED_END.get(tag, ())
+        while self.stack and self.stack[-1] in implied:
+            self._close(self.stack.pop())
+        self.out.append(self._start_tag(tag, cleaned))
+        if tag in VOID_TAGS:
+            return
+        self.stack.append(tag)
+        if tag in ANCHOR_TAGS and self.heading is None:
+            self.heading = (len(self.out) - 1, tag, cleaned, [])
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.dropping is not None:
+            if tag == self.dropping:
+                self.drop_depth -= 1
+                if not self.drop_depth:
+                    self.dropping = None
+            return
+        if tag not in self.stack:
+            return
+        # 自动闭合中间没有闭合的标签
+        while self.stack:
+            open_tag = self.stack.pop()
+            self._close(open_tag)
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self.dropping is not None:
+            return
+        if self.heading is not None:
+            self.heading[3].append(data)
+        self.out.append(escape(data, quote=False))
+
+    def _close(self, tag):
+        self.out.append(f'</{tag}>')
+        if self.heading is not None and self.heading[1] == tag:
+            index, _, attrs, texts = self.heading
+            self.heading = None
+            slug = _slugify(''.join(texts))
+            if slug:
+                slug = ANCHOR_PREFIX + slug
+                unique, number = slug, 1
+                while unique in self.slugs:
+                    number += 1
+                    unique = f'{slug}-{number}'
+                self.slugs.add(unique)
+                self.out[index] = self._start_tag(tag, attrs + [('id', unique)])
+
+    @staticmethod
+    def _start_tag(tag, attrs):
+        rendered = ''.join(f' {name}="{escape(value)}"' for name, value in attrs)
+        return f'<{tag}{rendered}>'
+
+    def close(self):
+        super().close()
+        while self.stack:
+            self._close(self.stack.pop())
+        return ''.join(self.out)
+
+
+def render_body(body):
+    '''把编辑器提交的正文渲染为可以直接输出的 HTML，在保存文章时调用一次'''
+    sanitizer = Sanitizer()
+    sanitizer.feed(body or '')
+    return sanitizer.close()
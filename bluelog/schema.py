@@ -0,0 +1,91 @@
+from flask import current_app
+from flask_migrate import stamp, upgrade
+from sqlalchemy import inspect
+
+from bluelog.extensions import db
+from bluelog.models import Post, Category, Comment
+from bluelog.search import drop_index
+
+
+# 引入迁移之前 db.create_all() 建立的表结构，见 migrations/versions
+BASELINE_REVISION = '474ad7e26318'
+
+
+def reset_schema():
+    '''
+    删除并按模型重新建表，再把迁移版本标记为最新，之后照常用 flask db upgrade 升级。
+    搜索索引一并清空，否则旧索引会指向重新分配给新文章的 id
+    '''
+    drop_index()
+    db.drop_all()
+    db.create_all()
+    stamp()
+
+
+def adopt():
+    '''
+    把没有迁移记录的数据库纳入迁移管理并升级到最新版本，返回标记的起始版本，已经纳入管理时返回 None。
+    空数据库直接执行全部迁移。补齐新加的计数字段、评论路径和文章摘要，正文 HTML 和搜索索引需要另外运行命令生成。
+    '''
+    tables = inspect(db.engine).get_table_names()
+    if 'alembic_version' in tables:
+        return None
+    revision = None
+    if 'post' in tables:
+        revision = BASELINE_REVISION
+        stamp(revision=revision)
+    upgrade()
+    if revision is not None:
+        Category.recount()
+        Post.recount()
+        db.session.commit()
+        if db.session.query(Comment.id).filter(Comment.path.is_(None)).first() is not None:
+            Comment.rebuild_paths()
+        # 列表页只读取摘要，不回退到正文
+        Post.update_excerpts()
+    return revision
+
+
+def explain_queries():
+    '''主要端点使用的查询，参数取自当前数据：(名称, 查询)'''
+    per_page = current_app.config['BLOG_POST_PER_PAGE']
+    comment_per_page = current_app.config['BLOG_COMMENT_PER_PAGE']
+    order = (Post.timestamp.desc(), Post.id.desc())
+    comment_order = (Comment.timestamp.desc(), Comment.id.desc())
+    category = Category.query.order_by(Category.post_count.desc()).first()
+    post = Post.query.order_by(Post.comment_count.desc()).first()
+    category_id = category.id if category else 1
+    post_id = post.id if post else 1
+    roots = Comment.query.filter_by(post_id=post_id, replied_id=None)
+    root_ids = [comment.id for comment in roots.order_by(*comment_order).limit(comment_per_page)] or [1]
+
+    return [
+        ('index', Post.query.options(db.defer(Post.body), db.joinedload(Post.category))
+            .order_by(*order).limit(per_page)),
+        ('show_category', Post.query.filter_by(category_id=category_id)
+            .options(db.defer(Post.body), db.joinedload(Post.category)).order_by(*order).limit(per_page)),
+        ('show_post roots', roots.order_by(*comment_order).limit(comment_per_page)),
+        ('show_post replies', Comment.query.filter(Comment.thread_id.in_(root_ids), Comment.replied_id.isnot(None))
+            .order_by(Comment.path)),
+        ('manage_comment unread', Comment.query.filter_by(read=False).order_by(*comment_order).limit(comment_per_page)),
+        ('unread count', Comment.query.filter_by(read=False).with_entities(db.func.count(Comment.id))),
+        ('manage_comment all', Comment.query.order_by(*comment_order).limit(comment_per_page)),
+    ]
+
+
+def explain(query):
+    '''返回查询的执行计划 (列名, 各行)，支持 SQLite 和 MySQL'''
+    dialect = db.engine.dialect
+    if dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    elif dialect.name == 'mysql':
+        prefix = 'EXPLAIN '
+    else:
+        raise ValueError(f'Unsupported database: {dialect.name}')
+    compiled = query.statement.compile(dialect=dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    connection = db.session.connection()
+    result = connection.execute(prefix + str(compiled), params)
+    return list(result.keys()), [tuple(row) for row in result]
@@ -0,0 +1,221 @@
+import math
+import re
+from collections import Counter
+
+from flask import current_app
+from markupsafe import Markup
+from sqlalchemy import func, text, bindparam
+
+from bluelog.extensions import db
+from bluelog.models import Post, SearchTerm, SearchDocument
+
+
+TITLE_WEIGHT = 3
+# BM25 参数
+K1 = 1.2
+B = 0.75
+
+_token_re = re.compile(r'[\u3400-\u9fff\uf900-\ufaff]+|[a-z0-9]+')
+_cjk_re = re.compile(r'[\u3400-\u9fff\uf900-\ufaff]')
+
+
+def tokenize(text, for_index=False):
+    '''
+    中文按相邻两个字切分（单独一个字保留原样），西文按单词切分，统一转为小写。
+    for_index 为真时每段中文的最后一个字再单独作为一个词，这样每个字都是某个索引词的开头，
+    只有一个字的查询可以按前缀匹配，见 is_prefix_term()。
+    '''
+    tokens = []
+    for run in _token_re.findall(text.lower()):
+        if _cjk_re.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+                if for_index:
+                    tokens.append(run[-1])
+        else:
+            tokens.append(run[:64])
+    return tokens
+
+
+def is_prefix_term(term):
+    '''单个汉字的查询词匹配所有以它开头的索引词，否则“博”搜不到只索引为“博客”的文章'''
+    return len(term) == 1 and _cjk_re.match(term) is not None
+
+
+def _post_tokens(title, body):
+    return tokenize(title or '', for_index=True), tokenize(Markup(body or '').striptags(), for_index=True)
+
+
+class TableIndex:
+    '''
+    倒排索引存放在 search_term / search_document 两张普通表中，适用于 MySQL 等没有 FTS5 的数据库。
+    查询时取出各个词的倒排列表，在 Python 中计算 BM25，要求结果包含所有查询词。
+    '''
+
+    def index(self, post_id, title, body):
+        self.remove([post_id])
+        title_tokens, body_tokens = _post_tokens(title, body)
+        frequencies = Counter(body_tokens)
+        for token in title_tokens:
+            frequencies[token] += TITLE_WEIGHT
+        db.session.bulk_insert_mappings(SearchTerm, [
+            {'term': term, 'post_id': post_id, 'frequency': frequency} for term, frequency in frequencies.items()
+        ])
+        db.session.bulk_insert_mappings(SearchDocument, [{'post_id': post_id, 'length': sum(frequencies.values())}])
+
+    def remove(self, post_ids):
+        SearchTerm.query.filter(SearchTerm.post_id.in_(post_ids)).delete(synchronize_session=False)
+        SearchDocument.query.filter(SearchDocument.post_id.in_(post_ids)).delete(synchronize_session=False)
+
+    def clear(self):
+        SearchTerm.query.delete(synchronize_session=False)
+        SearchDocument.query.delete(synchronize_session=False)
+
+    def search(self, terms, offset, limit):
+        count, total_length = db.session.query(func.count(SearchDocument.post_id),
+                                               func.sum(SearchDocument.length)).one()
+        if not count:
+            return [], 0
+        average_length = total_length / count
+
+        postings = {}
+        exact = [term for term in terms if not is_prefix_term(term)]
+        if exact:
+            for term, post_id, frequency in db.session.query(SearchTerm.term, SearchTerm.post_id,
+                                                             SearchTerm.frequency).filter(SearchTerm.term.in_(exact)):
+                postings.setdefault(term, {})[post_id] = frequency
+        for term in terms:
+            if is_prefix_term(term):
+                # 以这个字开头的各个词的词频合计为这个字的词频
+                for post_id, frequency in db.session.query(SearchTerm.post_id, func.sum(SearchTerm.frequency)) \
+                        .filter(SearchTerm.term.like(f'{term}%')).group_by(SearchTerm.post_id):
+                    postings.setdefault(term, {})[post_id] = frequency
+        if len(postings) < len(terms):
+            return [], 0
+
+        candidates = set.intersection(*(set(posting) for posting in postings.values()))
+        lengths = dict(db.session.query(SearchDocument.post_id, SearchDocument.length)
+                       .filter(SearchDocument.post_id.in_(candidates)))
+        scores = Counter()
+        for term, posting in postings.items():
+            idf = math.log((count - len(posting) + 0.5) / (len(posting) + 0.5) + 1)
+            for post_id in candidates:
+                frequency = posting[post_id]
+                norm = K1 * (1 - B + B * lengths.get(post_id, average_length) / average_length)
+                scores[post_id] += idf * frequency * (K1 + 1) / (frequency + norm)
+        ranked = [post_id for post_id, _ in scores.most_common()]
+        return ranked[offset:offset + limit], len(ranked)
+
+
+class FTS5Index:
+    '''
+    SQLite 的 FTS5 虚拟表 post_fts，rowid 即文章 id。写入的是 tokenize() 切好并用空格连接的词，
+    中文二元切分和 TableIndex 保持一致，排序使用 FTS5 内置的 bm25()。
+    '''
+
+    def __init__(self):
+        self._created = False
+
+    def ensure(self):
+        if not self._created:
+            db.session.execute(text('CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(title, body)'))
+            self._created = True
+
+    def index(self, post_id, title, body):
+        self.ensure()
+        self.remove([post_id])
+        title_tokens, body_tokens = _post_tokens(title, body)
+        db.session.execute(text('INSERT INTO post_fts (rowid, title, body) VALUES (:id, :title, :body)'),
+                           {'id': post_id, 'title': ' '.join(title_tokens), 'body': ' '.join(body_tokens)})
+
+    def remove(self, post_ids):
+        self.ensure()
+        db.session.execute(text('DELETE FROM post_fts WHERE rowid IN :ids')
+                           .bindparams(bindparam('ids', expanding=True)), {'ids': list(post_ids)})
+
+    def clear(self):
+        self.ensure()
+        db.session.execute(text('DELETE FROM post_fts'))
+
+    def search(self, terms, offset, limit):
+        self.ensure()
+        match = ' '.join(f'"{term}"*' if is_prefix_term(term) else f'"{term}"' for term in terms)
+        total = db.session.execute(text('SELECT count(*) FROM post_fts WHERE post_fts MATCH :match'),
+                                   {'match': match}).scalar()
+        rows = db.session.execute(
+            text(f'SELECT rowid FROM post_fts WHERE post_fts MATCH :match '
+                 f'ORDER BY bm25(post_fts, {TITLE_WEIGHT}.0, 1.0) LIMIT :limit OFFSET :offset'),
+            {'match': match, 'limit': limit, 'offset': offset})
+        return [row[0] for row in rows], total
+
+
+def _fts5_available():
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    options = [row[0] for row in db.session.execute(text('PRAGMA compile_options'))]
+    return 'ENABLE_FTS5' in options
+
+
+def search_index():
+    '''按 BLOG_SEARCH_BACKEND 选择索引实现，'auto' 时 SQLite 支持 FTS5 就用 FTS5'''
+    index = current_app.extensions.get('search_index')
+    if index is None:
+        backend = current_app.config['BLOG_SEARCH_BACKEND']
+        if backend == 'auto':
+            backend = 'fts5' if _fts5_available() else 'table'
+        index = FTS5Index() if backend == 'fts5' else TableIndex()
+        current_app.extensions['search_index'] = index
+    return index
+
+
+def drop_index():
+    '''删除 FTS5 虚拟表 post_fts，db.drop_all() 不会删除它；下次使用索引时重新建表'''
+    if db.engine.dialect.name == 'sqlite':
+        db.session.execute(text('DROP TABLE IF EXISTS post_fts'))
+        db.session.commit()
+    current_app.extensions.pop('search_index', None)
+
+
+def index_post(post):
+    '''新建或修改文章后更新索引，随调用方的事务一起提交'''
+    search_index().index(post.id, post.title, post.body)
+
+
+def remove_post(post_id):
+    search_index().remove([post_id])
+
+
+def remove_posts(post_ids):
+    '''批量删除文章后一次性清理它们的索引'''
+    if post_ids:
+        search_index().remove(post_ids)
+
+
+def search_posts(q, offset, limit):
+    '''返回 (按相关度排序的文章 id, 结果总数)'''
+    terms = list(dict.fromkeys(tokenize(q)))
+    if not terms:
+        return [], 0
+    return search_index().search(terms, offset, limit)
+
+
+def rebuild_index(batch=500):
+    '''清空后按 id 分批重建索引，每批提交一次，返回处理的文章数'''
+    index = search_index()
+    index.clear()
+    db.session.commit()
+    last_id = 0
+    total = 0
+    while True:
+        rows = db.session.query(Post.id, Post.title, Post.body).filter(Post.id > last_id) \
+            .order_by(Post.id).limit(batch).all()
+        if not rows:
+            break
+        for post_id, title, body in rows:
+            index.index(post_id, title, body)
+        db.session.commit()
+        last_id = rows[-1].id
+        total += len(rows)
+    return total
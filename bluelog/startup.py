@@ -0,0 +1,112 @@
+import json
+import subprocess
+import sys
+
+import click
+
+from bluelog.configs import basedir
+
+
+# 在新的解释器中运行，导入模块的耗时不受当前进程已经导入的模块影响。stdout 输出一行 JSON
+PROFILE_SCRIPT = '''
+import json, sys, time
+
+phases = {}
+init_apps = {}
+
+def timed(timings, name, func):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[name] = timings.get(name, 0) + time.perf_counter() - start
+    return wrapper
+
+start = time.perf_counter()
+import bluelog
+from bluelog import extensions
+import_time = time.perf_counter() - start
+
+for name in ('register_extensions', 'register_blueprints', 'register_commands', 'register_errors',
+             'register_template_context', 'register_shell_context', 'register_query_checks', 'compile_templates'):
+    setattr(bluelog, name, timed(phases, name, getattr(bluelog, name)))
+objects = {name: getattr(extensions, name) for name in dir(extensions)}
+objects.update(compressor=bluelog.compressor, page_cache=bluelog.page_cache, assets=bluelog.assets,
+               metrics=bluelog.metrics)
+for name, obj in objects.items():
+    if hasattr(obj, 'init_app') and not isinstance(obj, type):
+        obj.init_app = timed(init_apps, name, obj.init_app)
+
+start = time.perf_counter()
+app = bluelog.create_app(sys.argv[1])
+create_time = time.perf_counter() - start
+
+client = app.test_client()
+requests = []
+for _ in range(2):
+    start = time.perf_counter()
+    response = client.get(sys.argv[2])
+    requests.append((response.status_code, time.perf_counter() - start))
+
+print(json.dumps({'import': import_time, 'create_app': create_time, 'phases': phases,
+                  'init_app': init_apps, 'requests': requests}))
+'''
+
+
+def parse_importtime(text):
+    '''解析 python -X importtime 的输出，返回 [(模块, 自身耗时, 累计耗时, 层级)]，单位为微秒'''
+    modules = []
+    for line in text.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), int(fields[0]), int(fields[1]), depth))
+    return modules
+
+
+def package_totals(modules):
+    '''按顶层包汇总模块的自身耗时，返回 [(包名, 微秒)]，从大到小排列'''
+    totals = {}
+    for name, self_us, cumulative_us, depth in modules:
+        package = name.split('.')[0]
+        totals[package] = totals.get(package, 0) + self_us
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+
+def run_profile(config_name, url='/'):
+    '''在子进程中导入 bluelog、创建应用并请求两次 url，返回 (各阶段耗时, 模块导入耗时)'''
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROFILE_SCRIPT, config_name, url],
+                             cwd=basedir, capture_output=True, text=True)
+    output = process.stdout.strip().splitlines()
+    if process.returncode != 0 or not output:
+        raise click.ClickException('启动失败：\n' + process.stderr[-2000:])
+    return json.loads(output[-1]), parse_importtime(process.stderr)
+
+
+def print_report(timings, modules, limit=20):
+    ms = 1000
+    click.echo(f'导入 bluelog        {timings["import"] * ms:>9.1f}ms')
+    click.echo(f'create_app()        {timings["create_app"] * ms:>9.1f}ms')
+    # 按调用顺序输出各阶段，register_extensions 下列出每个扩展的 init_app
+    for name, seconds in timings['phases'].items():
+        click.echo(f'  {name:<28} {seconds * ms:>9.1f}ms')
+        if name == 'register_extensions':
+            for extension, seconds in sorted(timings['init_app'].items(), key=lambda item: item[1], reverse=True):
+                click.echo(f'    {extension + ".init_app":<26} {seconds * ms:>9.1f}ms')
+    for i, (status, seconds) in enumerate(timings['requests'], 1):
+        click.echo(f'第 {i} 次请求 ({status})   {seconds * ms:>9.1f}ms')
+
+    click.echo(f'\n累计耗时最多的模块（前 {limit} 个）')
+    for name, self_us, cumulative_us, depth in sorted(modules, key=lambda module: module[2], reverse=True)[:limit]:
+        click.echo(f'  {cumulative_us / ms:>9.1f}ms  {name}')
+    click.echo(f'\n自身耗时最多的模块（前 {limit} 个）')
+    for name, self_us, cumulative_us, depth in sorted(modules, key=lambda module: module[1], reverse=True)[:limit]:
+        click.echo(f'  {self_us / ms:>9.1f}ms  {name}')
+    click.echo(f'\n按顶层包汇总（前 {limit} 个）')
+    for package, total_us in package_totals(modules)[:limit]:
+        click.echo(f'  {total_us / ms:>9.1f}ms  {package}')
@@ -5,4 +5,20 @@ $(function () {
     $('[data-toggle="tooltip"]').tooltip(
         {title: render_time}
     );
+
+    // 批量操作表格的全选框，复选框通过 form 属性关联到 data-target 指定的表单
+    $('.select-all').change(function () {
+        $('input[name="ids"][form="' + $(this).data('target') + '"]').prop('checked', this.checked);
+    });
+
+    // 整页缓存和静态导出的页面中 CSRF 令牌是占位符（见 bluelog/caches.py），提交前换成当前会话的令牌
+    $('input[name="csrf_token"][value="csrf-token-placeholder"]').closest('form').one('submit', function (event) {
+        var form = this;
+        event.preventDefault();
+        $.getJSON($('body').data('csrf-token-url')).done(function (data) {
+            $(form).find('input[name="csrf_token"]').val(data.csrf_token);
+        }).always(function () {
+            form.submit();
+        });
+    });
 });
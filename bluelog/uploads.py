@@ -0,0 +1,247 @@
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from importlib.util import find_spec
+
+from flask import current_app, request, send_from_directory
+from werkzeug.security import safe_join
+
+
+class UploadError(Exception):
+    pass
+
+
+# 按文件头判断图片类型，不相信上传的扩展名
+_signatures = [
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+]
+
+# 原图为 <sha256 前 32 位>.<ext>，缩略图为 <hash>-<宽度>.<ext> 和 <hash>-<宽度>.webp
+_name_re = re.compile(r'^(?P<hash>[0-9a-f]{32})(?:-(?P<width>\d+))?\.(?P<ext>jpg|png|gif|webp)$')
+
+CHUNK_SIZE = 64 * 1024
+
+
+def image_type(head):
+    for signature, ext in _signatures:
+        if head.startswith(signature):
+            return ext
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def parse_name(filename):
+    '''解析上传文件名，返回 (hash, 宽度或 None, 扩展名)，不是本模块生成的文件名时返回 None'''
+    match = _name_re.match(filename)
+    if match is None:
+        return None
+    width = match.group('width')
+    return match.group('hash'), int(width) if width else None, match.group('ext')
+
+
+def variant_name(digest, width, ext):
+    return f'{digest}-{width}.{ext}'
+
+
+def save_upload(stream, upload_path, max_size):
+    '''
+    边读边写入临时文件并计算 sha256，超过 max_size 字节时中止。
+    以内容哈希命名，同一张图片只保存一份，返回 (文件名, 是否新文件)。
+    '''
+    os.makedirs(upload_path, exist_ok=True)
+    tmp_path = os.path.join(upload_path, f'.upload-{os.getpid()}-{threading.get_ident()}.tmp')
+    sha256 = hashlib.sha256()
+    size = 0
+    head = b''
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadError(f'图片不能超过 {max_size // 1024 // 1024}MB！')
+                if len(head) < 16:
+                    head += chunk[:16]
+                sha256.update(chunk)
+                f.write(chunk)
+        ext = image_type(head)
+        if ext is None:
+            raise UploadError('仅允许上传 JPG、PNG、GIF 或 WebP 图片！')
+        filename = f'{sha256.hexdigest()[:32]}.{ext}'
+        path = os.path.join(upload_path, filename)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            return filename, False
+        os.replace(tmp_path, path)
+        return filename, True
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def make_variants(path, widths, quality):
+    '''
+    在进程池中运行：为原图生成各个宽度的同格式缩略图和 WebP 版本，比目标宽度小的原图只生成 WebP。
+    GIF 可能是动图，不做处理。返回生成的文件名列表。
+    '''
+    from PIL import Image
+
+    directory, filename = os.path.split(path)
+    digest, _, ext = parse_name(filename)
+    if ext == 'gif':
+        return []
+    created = []
+    with Image.open(path) as image:
+        image.load()
+        for width in sorted(widths):
+            if image.width > width:
+                resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+            else:
+                resized = image
+            targets = [('webp', 'WEBP')]
+            if resized is not image and ext in ('jpg', 'png'):
+                targets.append((ext, 'JPEG' if ext == 'jpg' else 'PNG'))
+            for target_ext, target_format in targets:
+                name = variant_name(digest, width, target_ext)
+                target = os.path.join(directory, name)
+                if os.path.exists(target):
+                    continue
+                tmp_target = f'{target}.{os.getpid()}.tmp'
+                converted = resized
+                if target_format == 'JPEG' and converted.mode not in ('RGB', 'L'):
+                    converted = converted.convert('RGB')
+                converted.save(tmp_target, target_format, quality=quality, optimize=True)
+                os.replace(tmp_target, target)
+                created.append(name)
+            if resized is image:
+                break
+    return created
+
+
+class VariantPool:
+    '''
+    每个进程一个进程池，在后台生成缩略图，不阻塞上传请求。
+    gunicorn fork 出 worker 后进程号改变，进程池在第一次使用时重新创建。
+    未安装 Pillow 时不生成缩略图，始终返回原图。
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._available = None
+
+    @property
+    def available(self):
+        if self._available is None:
+            self._available = find_spec('PIL') is not None
+        return self._available
+
+    def _get_executor(self, max_workers):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=max_workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, app, filename):
+        if not self.available:
+            return None
+        path = os.path.join(app.config['CKEDITOR_UPLOAD_PATH'], filename)
+        executor = self._get_executor(app.config['BLOG_UPLOAD_WORKERS'])
+        future = executor.submit(make_variants, path, app.config['BLOG_UPLOAD_WIDTHS'],
+                                 app.config['BLOG_UPLOAD_QUALITY'])
+
+        def log_error(future):
+            if future.exception() is not None:
+                app.logger.error('Failed to make variants of %s: %s', filename, future.exception())
+
+        future.add_done_callback(log_error)
+        return future
+
+
+variant_pool = VariantPool()
+
+
+def display_name(filename):
+    '''CKEditor 插入正文的文件名：BLOG_UPLOAD_DISPLAY_WIDTH 宽的缩略图，生成之前访问时返回原图'''
+    digest, _, ext = parse_name(filename)
+    if ext == 'gif' or not variant_pool.available:
+        return filename
+    return variant_name(digest, current_app.config['BLOG_UPLOAD_DISPLAY_WIDTH'], ext)
+
+
+def resolve(filename, accept_webp=False):
+    '''
+    把请求的文件名解析为磁盘上实际存在的文件名：浏览器接受 WebP 且已生成时返回 WebP 版本，
+    缩略图尚未生成或原图比目标宽度小时返回原图，找不到时返回 None。
+    '''
+    upload_path = current_app.config['CKEDITOR_UPLOAD_PATH']
+    parsed = parse_name(filename)
+    if parsed is None:
+        # 改用内容哈希命名之前上传的文件
+        path = safe_join(upload_path, filename)
+        return filename if path is not None and os.path.isfile(path) else None
+    digest, width, ext = parsed
+    candidates = []
+    if accept_webp and width is not None and ext != 'webp':
+        candidates.append(variant_name(digest, width, 'webp'))
+    candidates.append(filename)
+    if width is not None:
+        candidates.append(f'{digest}.{ext}')
+    for candidate in candidates:
+        if os.path.isfile(os.path.join(upload_path, candidate)):
+            return candidate
+    return None
+
+
+def serve(filename):
+    '''
+    返回上传文件的响应。以内容哈希命名的文件内容不会变化，按文件名生成 ETag，
+    带 If-None-Match 或 If-Modified-Since 的请求不打开文件直接返回 304。
+    BLOG_UPLOAD_SENDFILE 为 'nginx' 或 'apache' 时只返回 X-Accel-Redirect / X-Sendfile 头，由前端服务器发送文件。
+    '''
+    parsed = parse_name(filename)
+    served = resolve(filename, request.accept_mimetypes['image/webp'] > 0)
+    if served is None:
+        return None
+
+    config = current_app.config
+    upload_path = config['CKEDITOR_UPLOAD_PATH']
+    # 请求的缩略图还没有生成时返回的是原图，只能短期缓存
+    immutable = parsed is not None and parse_name(served)[1] == parsed[1]
+    etag = served
+    mode = config['BLOG_UPLOAD_SENDFILE']
+
+    if request.if_none_match.contains(etag) or (immutable and request.if_modified_since is not None):
+        response = current_app.response_class(status=304)
+    elif mode == 'nginx':
+        response = current_app.response_class(mimetype=mimetypes.guess_type(served)[0])
+        response.headers['X-Accel-Redirect'] = config['BLOG_UPLOAD_ACCEL_PREFIX'].rstrip('/') + '/' + served
+    elif mode == 'apache':
+        response = current_app.response_class(mimetype=mimetypes.guess_type(served)[0])
+        response.headers['X-Sendfile'] = os.path.join(upload_path, served)
+    else:
+        # wsgi.file_wrapper 可用时 gunicorn 使用 sendfile() 发送
+        response = send_from_directory(upload_path, served, add_etags=False)
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = config['BLOG_UPLOAD_FALLBACK_MAX_AGE']
+    if parsed is not None and parsed[1] is not None:
+        response.vary.add('Accept')
+    return response
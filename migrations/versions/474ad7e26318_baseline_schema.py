@@ -0,0 +1,81 @@
+"""baseline schema
+
+The tables db.create_all() created before migrations were introduced.
+Existing databases are stamped with this revision by flask db-adopt.
+
+Revision ID: 474ad7e26318
+Revises: 
+Create Date: 2026-10-18 20:19:50.974189
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '474ad7e26318'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('admin',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('username', sa.String(length=20), nullable=True),
+    sa.Column('password_hash', sa.String(length=128), nullable=True),
+    sa.Column('blog_title', sa.String(length=60), nullable=True),
+    sa.Column('blog_sub_title', sa.String(length=100), nullable=True),
+    sa.Column('name', sa.String(length=30), nullable=True),
+    sa.Column('email', sa.String(length=254), nullable=True),
+    sa.Column('about', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('category',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=30), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_table('link',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=30), nullable=True),
+    sa.Column('url', sa.String(length=255), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('post',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.String(length=60), nullable=True),
+    sa.Column('body', sa.Text(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.Column('can_comment', sa.Boolean(), nullable=True),
+    sa.Column('category_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['category_id'], ['category.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_post_timestamp'), 'post', ['timestamp'], unique=False)
+    op.create_table('comment',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('author', sa.String(length=30), nullable=True),
+    sa.Column('email', sa.String(length=254), nullable=True),
+    sa.Column('body', sa.Text(), nullable=True),
+    sa.Column('from_admin', sa.Boolean(), nullable=True),
+    sa.Column('read', sa.Boolean(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.Column('post_id', sa.Integer(), nullable=True),
+    sa.Column('replied_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.ForeignKeyConstraint(['replied_id'], ['comment.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_comment_timestamp'), 'comment', ['timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_comment_timestamp'), table_name='comment')
+    op.drop_table('comment')
+    op.drop_index(op.f('ix_post_timestamp'), table_name='post')
+    op.drop_table('post')
+    op.drop_table('link')
+    op.drop_table('category')
+    op.drop_table('admin')
@@ -0,0 +1,127 @@
+"""counters, rendered bodies, comment paths, search and outbox
+
+Columns and tables added after the baseline schema. Databases created by
+db.create_all() at any point before migrations already have some of them,
+so every step is skipped when its table, column or index already exists.
+After upgrading such a database run flask recount, flask rebuild-threads,
+flask update-excerpts and flask reindex. flask db-adopt does the first three
+itself, so after it only flask reindex (and optionally flask rerender) is left.
+
+Revision ID: aea98a2b7389
+Revises: 474ad7e26318
+Create Date: 2026-10-18 20:20:09.666671
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'aea98a2b7389'
+down_revision = '474ad7e26318'
+branch_labels = None
+depends_on = None
+
+
+def _existing():
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+    columns = {table: {column['name'] for column in inspector.get_columns(table)} for table in tables}
+    indexes = {table: {index['name'] for index in inspector.get_indexes(table)} for table in tables}
+    return tables, columns, indexes
+
+
+def upgrade():
+    tables, columns, indexes = _existing()
+
+    if 'outbox' not in tables:
+        op.create_table('outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('recipient', sa.String(length=254), nullable=True),
+        sa.Column('subject', sa.String(length=100), nullable=True),
+        sa.Column('html', sa.Text(), nullable=True),
+        sa.Column('key', sa.String(length=100), nullable=True),
+        sa.Column('status', sa.String(length=10), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=True),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('timestamp', sa.DateTime(), nullable=True),
+        sa.Column('send_after', sa.DateTime(), nullable=True),
+        sa.Column('sent_at', sa.DateTime(), nullable=True),
+        sa.Column('lock_token', sa.String(length=32), nullable=True),
+        sa.Column('locked_until', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+        with op.batch_alter_table('outbox', schema=None) as batch_op:
+            batch_op.create_index(batch_op.f('ix_outbox_key'), ['key'], unique=False)
+            batch_op.create_index(batch_op.f('ix_outbox_lock_token'), ['lock_token'], unique=False)
+            batch_op.create_index(batch_op.f('ix_outbox_send_after'), ['send_after'], unique=False)
+            batch_op.create_index(batch_op.f('ix_outbox_status'), ['status'], unique=False)
+
+    if 'search_document' not in tables:
+        op.create_table('search_document',
+        sa.Column('post_id', sa.Integer(), nullable=False),
+        sa.Column('length', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['post_id'], ['post.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('post_id')
+        )
+    if 'search_term' not in tables:
+        op.create_table('search_term',
+        sa.Column('term', sa.String(length=64), nullable=False),
+        sa.Column('post_id', sa.Integer(), nullable=False),
+        sa.Column('frequency', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['post_id'], ['post.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('term', 'post_id')
+        )
+        with op.batch_alter_table('search_term', schema=None) as batch_op:
+            batch_op.create_index(batch_op.f('ix_search_term_post_id'), ['post_id'], unique=False)
+
+    if 'post_count' not in columns['category']:
+        with op.batch_alter_table('category', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('post_count', sa.Integer(), server_default='0', nullable=False))
+
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        if 'path' not in columns['comment']:
+            batch_op.add_column(sa.Column('path', sa.String(length=256), nullable=True))
+        if 'thread_id' not in columns['comment']:
+            batch_op.add_column(sa.Column('thread_id', sa.Integer(), nullable=True))
+        if 'ix_comment_thread_id' not in indexes['comment']:
+            batch_op.create_index(batch_op.f('ix_comment_thread_id'), ['thread_id'], unique=False)
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        for column in (sa.Column('body_html', sa.Text(), nullable=True),
+                       sa.Column('comment_count', sa.Integer(), server_default='0', nullable=False),
+                       sa.Column('excerpt', sa.Text(), nullable=True),
+                       sa.Column('render_version', sa.Integer(), nullable=True),
+                       sa.Column('word_count', sa.Integer(), server_default='0', nullable=False)):
+            if column.name not in columns['post']:
+                batch_op.add_column(column)
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('word_count')
+        batch_op.drop_column('render_version')
+        batch_op.drop_column('excerpt')
+        batch_op.drop_column('comment_count')
+        batch_op.drop_column('body_html')
+
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_comment_thread_id'))
+        batch_op.drop_column('thread_id')
+        batch_op.drop_column('path')
+
+    with op.batch_alter_table('category', schema=None) as batch_op:
+        batch_op.drop_column('post_count')
+
+    with op.batch_alter_table('search_term', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_search_term_post_id'))
+
+    op.drop_table('search_term')
+    op.drop_table('search_document')
+    with op.batch_alter_table('outbox', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_outbox_status'))
+        batch_op.drop_index(batch_op.f('ix_outbox_send_after'))
+        batch_op.drop_index(batch_op.f('ix_outbox_lock_token'))
+        batch_op.drop_index(batch_op.f('ix_outbox_key'))
+
+    op.drop_table('outbox')
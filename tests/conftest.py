@@ -0,0 +1,45 @@
+import pytest
+
+from bluelog import create_app
+from bluelog.caches import site_cache, get_admin, get_categories, get_links
+from bluelog.configs import TestingConfig
+from bluelog.fakes import fake_admin, fake_links, bulk_forge
+from bluelog.models import Admin
+from bluelog.schema import reset_schema
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    '''
+    生成数据后退出应用上下文：请求在测试客户端自己的上下文中执行，
+    否则记录到的查询会和生成数据时的查询累积在一起
+    '''
+    monkeypatch.setattr(TestingConfig, 'BLOG_CACHE_DIR', str(tmp_path / 'cache'))
+    app = create_app('testing')
+    with app.app_context():
+        reset_schema()
+        fake_admin()
+        bulk_forge(categories=5, posts=60, comments=600, seed=0)
+        fake_links()
+        site_cache.expire()
+        # 预热站点缓存，和已经运行了一段时间的 worker 一样，query_budget 按这种情况声明
+        get_admin()
+        get_categories()
+        get_links()
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def admin_client(app):
+    client = app.test_client()
+    with app.app_context():
+        admin_id = Admin.query.first().id
+    with client.session_transaction() as session:
+        session['_user_id'] = str(admin_id)
+        session['_fresh'] = True
+    return client
@@ -0,0 +1,102 @@
+import smtplib
+from datetime import datetime, timedelta
+
+import flask_mail
+import pytest
+
+from bluelog.emails import _claim, deliver_pending, send_mail
+from bluelog.extensions import db, mail
+from bluelog.models import Outbox
+
+
+@pytest.fixture
+def outbox(app):
+    '''TESTING 下 Flask-Mail 不连接 SMTP 服务器，发出的邮件由 record_messages() 记录'''
+    with app.app_context():
+        Outbox.query.delete()
+        db.session.commit()
+        with mail.record_messages() as sent:
+            yield sent
+
+
+def due(outbox_id):
+    '''把邮件的发送时间提前到现在，代替等待合并窗口或重试间隔'''
+    Outbox.query.filter_by(id=outbox_id).update({Outbox.send_after: datetime.utcnow()})
+    db.session.commit()
+
+
+def test_coalesce_pending(outbox):
+    first = send_mail('新评论', 'admin@example.com', '<p>1</p>', key='new-comment:1')
+    second = send_mail('新评论', 'admin@example.com', '<p>2</p>', key='new-comment:1')
+    other = send_mail('新评论', 'admin@example.com', '<p>3</p>', key='new-comment:2')
+    assert second.id == first.id
+    assert other.id != first.id
+    assert deliver_pending() == 2
+    assert [message.html for message in outbox] == ['<p>1</p>', '<p>3</p>']
+
+
+def test_coalesce_window(app, outbox):
+    first = send_mail('新评论', 'admin@example.com', '<p>1</p>', key='new-comment:1')
+    deliver_pending()
+    second = send_mail('新评论', 'admin@example.com', '<p>2</p>', key='new-comment:1')
+    window = timedelta(seconds=app.config['BLOG_MAIL_COALESCE_WINDOW'])
+    assert second.send_after == Outbox.query.get(first.id).sent_at + window
+    assert deliver_pending() == 0
+    due(second.id)
+    assert deliver_pending() == 1
+    assert len(outbox) == 2
+
+
+def test_comment_while_sending(app, outbox):
+    first = send_mail('新评论', 'admin@example.com', '<p>1</p>', key='new-comment:1')
+    # worker 已经领取了这封邮件，还没有发送完
+    assert [claimed.id for claimed in _claim(10)] == [first.id]
+    second = send_mail('新评论', 'admin@example.com', '<p>2</p>', key='new-comment:1')
+    assert second.id != first.id
+    assert second.send_after > datetime.utcnow()
+    Outbox.query.filter_by(id=first.id).update({Outbox.lock_token: None, Outbox.locked_until: None})
+    db.session.commit()
+    assert deliver_pending() == 1
+    due(second.id)
+    assert deliver_pending() == 1
+    assert [message.html for message in outbox] == ['<p>1</p>', '<p>2</p>']
+
+
+def test_retry_after_failure(app, outbox, monkeypatch):
+    app.config['BLOG_MAIL_MAX_ATTEMPTS'] = 2
+    send = flask_mail.Connection.send
+    failures = []
+
+    def flaky_send(self, message, envelope_from=None):
+        if len(failures) < 1:
+            failures.append(message)
+            raise smtplib.SMTPServerDisconnected('connection lost')
+        return send(self, message, envelope_from)
+
+    monkeypatch.setattr(flask_mail.Connection, 'send', flaky_send)
+    item = send_mail('新回复', 'guest@example.com', '<p>reply</p>')
+    assert deliver_pending() == 1
+    item = Outbox.query.get(item.id)
+    assert (item.status, item.attempts, item.lock_token) == ('pending', 1, None)
+    assert item.send_after > datetime.utcnow() + timedelta(seconds=app.config['BLOG_MAIL_RETRY_DELAY'] - 5)
+    assert deliver_pending() == 0
+    due(item.id)
+    assert deliver_pending() == 1
+    assert Outbox.query.get(item.id).status == 'sent'
+    assert len(outbox) == 1
+
+
+def test_give_up_after_max_attempts(app, outbox, monkeypatch):
+    app.config['BLOG_MAIL_MAX_ATTEMPTS'] = 2
+
+    def broken_send(self, message, envelope_from=None):
+        raise smtplib.SMTPServerDisconnected('connection lost')
+
+    monkeypatch.setattr(flask_mail.Connection, 'send', broken_send)
+    item = send_mail('新回复', 'guest@example.com', '<p>reply</p>')
+    deliver_pending()
+    due(item.id)
+    deliver_pending()
+    item = Outbox.query.get(item.id)
+    assert (item.status, item.attempts, item.last_error) == ('failed', 2, 'connection lost')
+    assert outbox == []
@@ -0,0 +1,11 @@
+import pytest
+
+
+@pytest.mark.parametrize('url', ['/feed.xml', '/category/1/feed.xml', '/sitemap.xml'])
+def test_cached_xml_ignores_request_host(app, client, url):
+    app.config['BLOG_BASE_URL'] = 'https://blog.example.com/'
+    client.get(f'{url}?utm=x', base_url='http://evil.example')
+    body = client.get(url).get_data(as_text=True)
+    assert 'evil.example' not in body
+    assert 'utm' not in body
+    assert 'https://blog.example.com/' in body
@@ -0,0 +1,34 @@
+import json
+import os
+
+from bluelog.metrics import AGGREGATE_FILE, exposition, merge, metrics
+
+
+def index_requests(snapshots):
+    totals = merge(snapshots, metrics.buckets)
+    return sum(count for endpoint, method, status, count in totals['requests'] if endpoint == 'blog.index')
+
+
+def write_snapshot(snapshot, **values):
+    snapshot = dict(snapshot, requests=[['blog.index', 'GET', 200, 5]], **values)
+    with open(os.path.join(metrics.directory, f'{snapshot["name"]}.json'), 'w') as f:
+        json.dump(snapshot, f)
+
+
+def test_collect_folds_exited_workers(app, client):
+    client.get('/')
+    metrics.flush()
+    own = f'{metrics.snapshot()["name"]}.json'
+    assert own.startswith(f'{os.getpid()}-')
+    snapshot = metrics.snapshot()
+    # 已经退出的 worker，以及进程号被当前进程重用的旧 worker
+    write_snapshot(snapshot, name='999999-dead', pid=999999, time=snapshot['time'] - 100)
+    write_snapshot(snapshot, name=f'{os.getpid()}-old', time=snapshot['time'] - 50)
+
+    with app.app_context():
+        before = metrics.collect(include_self=False)
+        after = metrics.collect(include_self=False)
+    assert sorted(os.listdir(metrics.directory)) == ['.lock', own, AGGREGATE_FILE]
+    assert index_requests(after) == index_requests(before)
+    assert sum(1 for snapshot in after if snapshot.get('live')) == 1
+    assert 'bluelog_workers 1\n' in ''.join(exposition(after, metrics.buckets))
@@ -0,0 +1,84 @@
+import pytest
+
+from flask_sqlalchemy import get_debug_queries
+
+from bluelog.configs import TestingConfig
+from bluelog.models import Category, Post
+from bluelog.querybudget import assert_query_count, record_queries
+
+
+def budget(app, endpoint):
+    '''视图上 @query_budget 声明的语句数'''
+    return app.view_functions[endpoint].query_budget
+
+
+@pytest.fixture(params=['client', 'admin_client'])
+def any_client(request):
+    '''访客和管理员各请求一次，管理员多一次读取用户的查询'''
+    return request.getfixturevalue(request.param)
+
+
+def test_index(app, any_client):
+    assert_query_count(any_client, '/', budget(app, 'blog.index'))
+    assert_query_count(any_client, '/?page=2', budget(app, 'blog.index'))
+
+
+def test_about(app, any_client):
+    assert_query_count(any_client, '/about/', budget(app, 'blog.about'))
+
+
+def test_show_category(app, any_client):
+    with app.app_context():
+        category_id = Category.query.order_by(Category.post_count.desc()).first().id
+    response = assert_query_count(any_client, f'/category/{category_id}/', budget(app, 'blog.show_category'))
+    assert response.status_code == 200
+    assert any_client.get('/category/999/').status_code == 404
+
+
+def test_show_post(app, any_client):
+    with app.app_context():
+        post_id = Post.query.order_by(Post.comment_count.desc()).first().id
+    for page in (1, 2):
+        response = assert_query_count(any_client, f'/post/{post_id}/?page={page}', budget(app, 'blog.show_post'))
+        assert response.status_code == 200
+
+
+def test_manage_post(app, admin_client):
+    response = assert_query_count(admin_client, '/admin/post/manage/', budget(app, 'admin.manage_post'))
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('filter_rule', ['unread', 'all', 'admin'])
+def test_manage_comment(app, admin_client, filter_rule):
+    response = assert_query_count(admin_client, f'/admin/comment/manage/?filter={filter_rule}',
+                                  budget(app, 'admin.manage_comment'))
+    assert response.status_code == 200
+
+
+@pytest.fixture
+def unrecorded(monkeypatch):
+    '''和生产配置一样关闭 SQLALCHEMY_RECORD_QUERIES，需要在 app 之前请求'''
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_RECORD_QUERIES', False)
+
+
+def test_count_without_record_queries(unrecorded, app, client):
+    with client, record_queries(app) as recorded:
+        client.get('/')
+        assert get_debug_queries() == []
+    (endpoint, queries), = recorded
+    assert endpoint == 'blog.index'
+    assert 0 < len(queries) <= budget(app, 'blog.index')
+    with pytest.raises(AssertionError, match='executed'):
+        assert_query_count(client, '/', 0)
+
+
+def test_list_pages_skip_bodies(app, client, admin_client):
+    with app.app_context():
+        category_id = Category.query.first().id
+    with record_queries(app) as recorded:
+        client.get('/')
+        client.get(f'/category/{category_id}/')
+        admin_client.get('/admin/post/manage/')
+    statements = [query.statement for _, queries in recorded for query in queries]
+    assert statements
+    assert not any('post.body' in statement for statement in statements)
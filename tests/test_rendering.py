@@ -0,0 +1,23 @@
+from bluelog.rendering import render_body
+
+
+def test_heading_ids_do_not_collide_with_page_ids():
+    html = render_body('<h2>Comments</h2><h2>Comment form</h2><h2>Comments</h2>')
+    assert html == ('<h2 id="h-comments">Comments</h2><h2 id="h-comment-form">Comment form</h2>'
+                    '<h2 id="h-comments-2">Comments</h2>')
+
+
+def test_keeps_editor_formatting():
+    html = render_body('<span style="color: #e74c3c; background-color: rgb(255, 255, 0); font-size: 18px; '
+                       'mso-bidi-font-family: Arial">x</span>')
+    assert html == '<span style="color: #e74c3c; background-color: rgb(255, 255, 0); font-size: 18px">x</span>'
+
+
+def test_drops_unsafe_style_values():
+    html = render_body('<p style="background-color: url(javascript:alert(1)); color: expression(alert(1))">x</p>')
+    assert html == '<p>x</p>'
+
+
+def test_target_links_get_rel():
+    html = render_body('<a href="https://example.com/" target="_blank">x</a>')
+    assert html == '<a href="https://example.com/" target="_blank" rel="noopener noreferrer">x</a>'
@@ -0,0 +1,55 @@
+import pytest
+
+from bluelog.extensions import db
+from bluelog.fakes import bulk_forge, fake_admin
+from bluelog.models import Category, Post
+from bluelog.schema import reset_schema
+from bluelog.search import index_post, search_posts, tokenize
+
+
+@pytest.fixture(params=['table', 'fts5'])
+def search_app(app, request):
+    app.config['BLOG_SEARCH_BACKEND'] = request.param
+    app.extensions.pop('search_index', None)
+    with app.app_context():
+        if request.param == 'fts5':
+            options = [row[0] for row in db.session.execute('PRAGMA compile_options')]
+            if 'ENABLE_FTS5' not in options:
+                pytest.skip('SQLite 没有编译 FTS5')
+        post = Post(title='我的博客', body='<p>记录 Flask 开发</p>', category=Category.query.first())
+        db.session.add(post)
+        db.session.flush()
+        index_post(post)
+        db.session.commit()
+        yield post.id
+
+
+def test_tokenize():
+    assert tokenize('我的博客 Flask') == ['我的', '的博', '博客', 'flask']
+    assert tokenize('我的博客', for_index=True) == ['我的', '的博', '博客', '客']
+
+
+@pytest.mark.parametrize('q', ['博客', '博', '客', '我的', 'flask', '记录 开发'])
+def test_search_matches(search_app, q):
+    post_ids, total = search_posts(q, 0, 10)
+    assert search_app in post_ids
+
+
+def test_search_requires_all_terms(search_app):
+    assert search_app not in search_posts('博 不存在', 0, 10)[0]
+
+
+def test_reset_schema_clears_index(search_app, app):
+    with app.app_context():
+        # 第二次生成数据，文章 id 从 1 重新分配
+        reset_schema()
+        fake_admin()
+        bulk_forge(categories=2, posts=5, comments=0, seed=1)
+        assert search_posts('博客', 0, 10) == ([], 0)
+        post = Post(title='重新生成', body='<p>新的文章</p>', category=Category.query.first())
+        db.session.add(post)
+        db.session.flush()
+        index_post(post)
+        db.session.commit()
+        assert search_posts('博客', 0, 10) == ([], 0)
+        assert search_posts('重新生成', 0, 10) == ([post.id], 1)
@@ -0,0 +1,25 @@
+import io
+
+import pytest
+
+from bluelog.configs import TestingConfig
+
+
+@pytest.fixture
+def csrf_enabled(monkeypatch):
+    '''和生产配置一样打开 CSRF 保护，上传限制改小，需要在 app 之前请求'''
+    monkeypatch.setattr(TestingConfig, 'WTF_CSRF_ENABLED', True)
+    monkeypatch.setattr(TestingConfig, 'MAX_CONTENT_LENGTH', 4096)
+
+
+def test_upload_too_large(csrf_enabled, app, admin_client):
+    data = {'upload': (io.BytesIO(b'\0' * 8192), 'large.png')}
+    response = admin_client.post('/admin/upload/', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert response.json['uploaded'] == 0
+    assert '图片不能超过' in response.json['error']['message']
+
+
+def test_other_request_too_large(csrf_enabled, app, admin_client):
+    response = admin_client.post('/admin/post/new/', data={'body': 'x' * 8192})
+    assert response.status_code == 413